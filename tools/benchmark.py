@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Benchmarks of the Python preprocessing paths of xnat_reface.py and of ScanClassifierCSV, run against synthetic DICOM
+# series and scaled-up copies of the classifier CSV. Results are written as JSON so releases can be compared.
+#
+# ~ Sample command:
+# python tools/benchmark.py --slices 64 256 --matrix 256 --modality CT MR --repeat 5 --output benchmark.json
+# python tools/benchmark.py --multiframe --csv_scales 1 8 32 --workers 4
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+WORKSPACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workspace')
+sys.path.insert(0, WORKSPACE)
+
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+import xnat_reface
+from ScanClassifierCSV import ScanClassifierCSV
+
+
+SOP_CLASSES = {
+    'CT': ('1.2.840.10008.5.1.4.1.1.2', '1.2.840.10008.5.1.4.1.1.2.1'),
+    'MR': ('1.2.840.10008.5.1.4.1.1.4', '1.2.840.10008.5.1.4.1.1.4.1'),
+    'PT': ('1.2.840.10008.5.1.4.1.1.128', '1.2.840.10008.5.1.4.1.1.130'),
+}
+
+# Stand-in for run_mri_reface.sh: copies the input DICOM to output/dcm and writes NIfTI and QC outputs of the given size
+STUB_SCRIPT = '''#!/bin/sh
+mkdir -p "$2/dcm"
+cp "$1"/* "$2/dcm/"
+for name in scan_deFaced.nii scan_Warp.nii scan.nii; do
+    head -c {nifti_bytes} /dev/zero > "$2/$name"
+done
+echo png > "$2/scan_render.png"
+'''
+
+
+# Write a synthetic series of slices rows x columns 16-bit images. Single-frame series get one file per slice, with
+# every fourth file missing its Manufacturer; multi-frame series are a single enhanced file holding all slices.
+def generate_series(series_dir, slices, rows, columns, modality='CT', multiframe=False):
+    os.makedirs(series_dir, exist_ok=True)
+    single_frame_class, multi_frame_class = SOP_CLASSES[modality]
+    series_uid = generate_uid()
+    frame = (bytes(range(256)) * (rows * columns * 2 // 256 + 1))[:rows * columns * 2]
+    files = [(0, slices)] if multiframe else [(index, 1) for index in range(slices)]
+    for index, frames in files:
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = multi_frame_class if multiframe else single_frame_class
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        dicom = Dataset()
+        dicom.file_meta = meta
+        dicom.SOPClassUID = meta.MediaStorageSOPClassUID
+        dicom.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        dicom.SeriesInstanceUID = series_uid
+        dicom.Modality = modality
+        dicom.BodyPartExamined = 'HEAD'
+        if index % 4 != 3:
+            dicom.Manufacturer = 'SYNTHETIC'
+        dicom.ProtocolName = 'Benchmark protocol'
+        dicom.SeriesDescription = 'Benchmark series'
+        dicom.WindowCenter = 40
+        dicom.WindowWidth = 400
+        dicom.WindowCenterWidthExplanation = 'BRAIN'
+        dicom.InstanceNumber = index + 1
+        dicom.Rows = rows
+        dicom.Columns = columns
+        dicom.BitsAllocated = 16
+        dicom.BitsStored = 16
+        dicom.HighBit = 15
+        dicom.PixelRepresentation = 0
+        dicom.SamplesPerPixel = 1
+        dicom.PhotometricInterpretation = 'MONOCHROME2'
+        if multiframe:
+            dicom.NumberOfFrames = frames
+        dicom.PixelData = frame * frames
+        dicom.save_as(os.path.join(series_dir, f'{index:05d}.dcm'), enforce_file_format=True)
+    return series_dir
+
+
+# Run func repeat times and return wall time statistics in seconds. setup, if given, runs untimed before each call.
+def time_call(func, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {'repeat': repeat, 'min': round(min(timings), 6), 'median': round(statistics.median(timings), 6),
+            'mean': round(statistics.mean(timings), 6), 'max': round(max(timings), 6)}
+
+
+def reset_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+# Time the DICOM preprocessing functions of xnat_reface.py on one synthetic series
+def benchmark_series(work_dir, config, repeat, workers):
+    series_dir = generate_series(os.path.join(work_dir, 'series'), config['slices'], config['matrix'],
+                                 config['matrix'], config['modality'], config['multiframe'])
+    staged_dir = os.path.join(work_dir, 'staged')
+    window_dir = os.path.join(work_dir, 'window')
+    output_dir = os.path.join(work_dir, 'output')
+    stub_script = os.path.join(work_dir, 'run_mri_reface.sh')
+    with open(stub_script, 'w') as f:
+        f.write(STUB_SCRIPT.format(nifti_bytes=config['slices'] * config['matrix'] * config['matrix'] * 2))
+    os.chmod(stub_script, 0o755)
+
+    def copy_series():
+        shutil.rmtree(window_dir, ignore_errors=True)
+        shutil.copytree(series_dir, window_dir)
+
+    def run_stub():
+        reset_dir(output_dir)
+        subprocess.run([stub_script, series_dir, output_dir], check=True)
+
+    def stage_nifti():
+        xnat_reface.stage_output_files(output_dir, os.path.join(output_dir, 'refaced_nifti'), '*deFaced.nii')
+        xnat_reface.stage_output_files(output_dir, os.path.join(output_dir, 'refaced_nifti'), '*Warp.nii')
+        xnat_reface.stage_output_files(output_dir, os.path.join(output_dir, 'nifti'), '*.nii')
+
+    def prepare_stage_outputs():
+        run_stub()
+        os.makedirs(os.path.join(output_dir, 'refaced_nifti'))
+        os.makedirs(os.path.join(output_dir, 'nifti'))
+
+    results = {
+        'get_window_tags': time_call(lambda: xnat_reface.get_window_tags(series_dir), repeat),
+        'is_missing_manufacture_tag': time_call(lambda: xnat_reface.is_missing_manufacture_tag(series_dir), repeat),
+        'add_manufacture_tag': time_call(
+            lambda: xnat_reface.add_manufacture_tag(series_dir, staged_dir, 'anonymized', workers), repeat,
+            setup=lambda: reset_dir(staged_dir)),
+        'delete_protocol_tags': time_call(
+            lambda: xnat_reface.delete_protocol_tags(series_dir, staged_dir, workers), repeat,
+            setup=lambda: reset_dir(staged_dir)),
+        'preprocess_input': time_call(
+            lambda: xnat_reface.preprocess_input(series_dir, staged_dir, True, 'anonymized', workers), repeat,
+            setup=lambda: shutil.rmtree(staged_dir, ignore_errors=True)),
+        'apply_window_tags': time_call(
+            lambda: xnat_reface.apply_window_tags(window_dir, 40, 400, 'BRAIN', workers), repeat,
+            setup=copy_series),
+        'stub_mri_reface': time_call(run_stub, repeat),
+        'stage_output_files': time_call(stage_nifti, repeat, setup=prepare_stage_outputs),
+        'stage_outputs': time_call(lambda: xnat_reface.stage_outputs(output_dir, False, workers), repeat,
+                                   setup=run_stub),
+    }
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+# Write a copy of csv_file with every row repeated scale times, each copy under its own experiment names
+def scale_csv(csv_file, scaled_file, scale):
+    with open(csv_file, newline='') as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    with open(scaled_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for copy in range(scale):
+            for row in rows:
+                writer.writerow(dict(row, experiment=f"{row['experiment']}_{copy}") if copy else row)
+    return scaled_file
+
+
+# Time loading and querying ScanClassifierCSV on a copy of csv_file scaled scale times
+def benchmark_csv(work_dir, csv_file, scale, repeat):
+    os.makedirs(work_dir, exist_ok=True)
+    scaled_file = scale_csv(csv_file, os.path.join(work_dir, f'classifier_x{scale}.csv'), scale)
+    classifier = ScanClassifierCSV(scaled_file, cache=False)
+    scans = classifier.scans()
+    experiment, scan = scans[-1]
+
+    def remove_cache():
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(classifier._cache_path())
+
+    results = {
+        'rows': sum(record.file_count for record in classifier.index.values()),
+        'scans': len(scans),
+        'load_full': time_call(lambda: ScanClassifierCSV(scaled_file, cache=False), repeat),
+        'load_until_last_scan': time_call(lambda: ScanClassifierCSV(scaled_file, experiment, scan, cache=False),
+                                          repeat),
+        'build_cache': time_call(lambda: ScanClassifierCSV(scaled_file), repeat, setup=remove_cache),
+        'load_cache': time_call(lambda: ScanClassifierCSV(scaled_file), repeat),
+        'get_scan_all': time_call(lambda: [classifier.get_scan(*key) for key in scans], repeat),
+        'get_im_types_all': time_call(lambda: classifier.get_im_types(scans, {}), repeat),
+    }
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=WORKSPACE, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_command_line_parameters():
+    parser = argparse.ArgumentParser(description='Benchmark the xnat_reface.py preprocessing paths')
+    parser.add_argument('--slices', type=int, nargs='+', default=[64, 256], help='Slice counts of synthetic series')
+    parser.add_argument('--matrix', type=int, nargs='+', default=[256], help='Rows and columns of synthetic series')
+    parser.add_argument('--modality', nargs='+', default=['CT'], choices=list(SOP_CLASSES),
+                        help='Modalities of synthetic series')
+    parser.add_argument('--multiframe', action='store_true',
+                        help='Also benchmark each series as a single multi-frame file')
+    parser.add_argument('--csv', default=os.path.join(WORKSPACE, 'classification_output_model.csv'),
+                        help='Classifier CSV scaled up for the ScanClassifierCSV benchmarks')
+    parser.add_argument('--csv_scales', type=int, nargs='*', default=[1, 4, 16],
+                        help='Number of copies of the classifier CSV rows in each ScanClassifierCSV benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes passed to the parallel functions')
+    parser.add_argument('--work_dir', default=None, help='Scratch directory (default: a temporary directory)')
+    parser.add_argument('--output', default='benchmark.json', help='JSON results file')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the benchmarked functions')
+    return parser.parse_args()
+
+
+def main():
+    params = parse_command_line_parameters()
+    work_dir = params.work_dir or tempfile.mkdtemp(prefix='mri_reface_benchmark-')
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'pydicom': pydicom.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'workers': params.workers,
+        'repeat': params.repeat,
+        'series': [],
+        'csv': [],
+    }
+    quiet = contextlib.nullcontext() if params.verbose else contextlib.redirect_stdout(io.StringIO())
+
+    configs = [{'slices': slices, 'matrix': matrix, 'modality': modality, 'multiframe': multiframe}
+               for modality in params.modality for matrix in params.matrix for slices in params.slices
+               for multiframe in ([False, True] if params.multiframe else [False])]
+    try:
+        for index, config in enumerate(configs):
+            print(f"Benchmarking series {config}", flush=True)
+            with quiet:
+                results = benchmark_series(os.path.join(work_dir, f'series-{index}'), config, params.repeat,
+                                           params.workers)
+            report['series'].append(dict(config, results=results))
+        for scale in params.csv_scales:
+            print(f"Benchmarking ScanClassifierCSV x{scale}", flush=True)
+            with quiet:
+                results = benchmark_csv(os.path.join(work_dir, f'csv-{scale}'), params.csv, scale, params.repeat)
+            report['csv'].append(dict(scale=scale, results=results))
+    finally:
+        if params.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(params.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote benchmark results to {params.output}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# Local stand-in for the XNAT endpoints used by mri_reface_launcher.py and xnat_reface.py, for exercising them
+# offline. Latency, stalls and error responses can be injected to test concurrency and retry behavior.
+#
+# ~ Sample command:
+# python tools/fake_xnat.py --port 8080 --project Test --csv workspace/sample.csv
+# python workspace/mri_reface_launcher.py --xnat_host http://localhost:8080 --xnat_user admin --xnat_pass admin --project Test --csv_input workspace/sample.csv --bulk
+# python tools/fake_xnat.py --experiments 1000 --latency 0.05 --jitter 0.05 --error_rate 0.02 --fault_pattern launch
+import argparse
+import csv
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+SCAN_ID_COLUMN = 'xnat:imagescandata/id'
+SCAN_FRAMES_COLUMN = 'xnat:imagescandata/frames'
+
+COMMANDS = [
+    {'name': 'mri_reface', 'xnat': [{'name': 'mri-reface-scan', 'id': 1}]},
+    {'name': 'mri_reface_highmem', 'xnat': [{'name': 'mri-reface-scan-highmem', 'id': 2}]},
+]
+
+
+class FakeXnat:
+    # experiment_scans maps each experiment label to its scan IDs. Requests whose path matches fault_pattern (all but
+    # the /fake/ endpoints by default) are delayed by latency plus up to jitter seconds; a stall_rate fraction of them
+    # are held for a further stall_seconds, and an error_rate fraction are answered with error_status instead.
+    def __init__(self, project, experiment_scans, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=503, stall_rate=0.0, stall_seconds=0.0, fault_pattern=None, seed=None):
+        self.project = project
+        self.experiments = {label: f'{project}_E{index:05d}' for index, label in enumerate(experiment_scans)}
+        self.labels = {experiment_id: label for label, experiment_id in self.experiments.items()}
+        # Resource labels of each (experiment ID, scan ID); launched containers are treated as finished immediately
+        self.resources = {(self.experiments[label], scan): ['DICOM']
+                          for label, scans in experiment_scans.items() for scan in scans}
+        # Frame count of each (experiment ID, scan ID); scans not listed have no frame count, as in XNAT before the
+        # scan is indexed
+        self.frames = {}
+        # If False, the project listing leaves out the scan columns, as servers that need an xsiType to join them do
+        self.list_scan_columns = True
+        self.launches = []
+        self.bulk_launches = []
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.fault_pattern = re.compile(fault_pattern) if fault_pattern else None
+        self.random = random.Random(seed)
+        # Requests served per method and status, and faults injected per kind
+        self.request_counts = Counter()
+        self.fault_counts = Counter()
+        self.in_flight = 0
+        self.idle = threading.Condition(self.lock)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def launch(self, wrapper_id, params):
+        with self.lock:
+            container_id = f'container-{next(self.ids)}'
+            self.launches.append({'wrapper-id': wrapper_id, 'container-id': container_id, 'params': params})
+            experiment_id, scan = parse_scan_uri(params.get('scan', ''))
+            if (experiment_id, scan) in self.resources:
+                self.resources[(experiment_id, scan)] = ['DICOM', 'REFACED_QC', 'REFACED_DICOM', 'NIFTI',
+                                                         'REFACED_NIFTI']
+        return {'status': 'success', 'container-id': container_id, 'params': params}
+
+    def bulk_launch(self, wrapper_id, params):
+        scans = json.loads(params['scan'])
+        successes = [self.launch(wrapper_id, dict(params, scan=scan)) for scan in scans]
+        with self.lock:
+            bulk_launch_id = f'bulk-{next(self.ids)}'
+            self.bulk_launches.append({'bulk-launch-id': bulk_launch_id, 'scans': scans})
+        return {'bulk-launch-id': bulk_launch_id, 'successes': successes, 'failures': []}
+
+    # Return the experiment ID for an experiment label or ID, or None
+    def experiment_id(self, experiment):
+        if experiment in self.labels:
+            return experiment
+        return self.experiments.get(experiment)
+
+    # Rows of the project experiment listing; with the scan ID column there is one row per scan, as in XNAT, and with
+    # the frames column each row also has its scan's frame count
+    def experiment_rows(self, columns=()):
+        if SCAN_ID_COLUMN not in columns or not self.list_scan_columns:
+            return [{'ID': experiment_id, 'label': label} for label, experiment_id in self.experiments.items()]
+        with self.lock:
+            scans = {}
+            for experiment_id, scan in self.resources:
+                scans.setdefault(experiment_id, []).append(scan)
+        rows = []
+        for label, experiment_id in self.experiments.items():
+            for scan in scans.get(experiment_id, ['']):
+                row = {'ID': experiment_id, 'label': label, SCAN_ID_COLUMN: scan}
+                if SCAN_FRAMES_COLUMN in columns:
+                    row[SCAN_FRAMES_COLUMN] = str(self.frames.get((experiment_id, scan), ''))
+                rows.append(row)
+        return rows
+
+    # JSON representation of an image session, in the shape XNAT returns for ?format=json
+    def experiment_json(self, experiment_id):
+        with self.lock:
+            scans = [{'data_fields': {'ID': scan},
+                      'children': [{'field': 'file', 'items': [{'data_fields': {'label': label}} for label in labels]}]}
+                     for (scan_experiment, scan), labels in self.resources.items() if scan_experiment == experiment_id]
+        return {'items': [{'data_fields': {'ID': experiment_id, 'label': self.labels[experiment_id]},
+                           'children': [{'field': 'scans/scan', 'items': scans}]}]}
+
+    # Delay the request and decide whether it fails. Returns the error status to answer with, or None.
+    def inject_faults(self, method, path):
+        if path.startswith('/fake/'):
+            return None
+        if self.fault_pattern is not None and not self.fault_pattern.search(path):
+            return None
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            stall = self.random.random() < self.stall_rate
+            error = self.random.random() < self.error_rate
+            if stall:
+                self.fault_counts['stall'] += 1
+            if error:
+                self.fault_counts[str(self.error_status)] += 1
+        time.sleep(delay + (self.stall_seconds if stall else 0))
+        return self.error_status if error else None
+
+    # Wait until no request is being handled, e.g. for stalled requests the client has given up on. Returns False if
+    # requests are still in flight after timeout seconds.
+    def wait_idle(self, timeout=None):
+        with self.idle:
+            return self.idle.wait_for(lambda: self.in_flight == 0, timeout)
+
+    def stats(self):
+        with self.lock:
+            launched_scans = Counter(launch['params'].get('scan') for launch in self.launches)
+            return {'requests': {f'{method} {status}': count for (method, status), count in
+                                 sorted(self.request_counts.items())},
+                    'faults': dict(self.fault_counts),
+                    'launches': len(self.launches), 'bulk-launches': len(self.bulk_launches),
+                    # Launches of a scan that was already launched, e.g. by a retry of a request that timed out
+                    'duplicate-launches': sum(count - 1 for count in launched_scans.values())}
+
+    def delete_resource(self, experiment_id, scan, resource):
+        with self.lock:
+            labels = self.resources.get((experiment_id, scan))
+            if labels is None or resource not in labels:
+                return False
+            labels.remove(resource)
+            return True
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately; without this, delayed ACKs hold every keep-alive response
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_one_request(self):
+                with fake.lock:
+                    fake.in_flight += 1
+                try:
+                    super().handle_one_request()
+                finally:
+                    with fake.idle:
+                        fake.in_flight -= 1
+                        fake.idle.notify_all()
+
+            def do_GET(self):
+                path = urlparse(self.path).path.rstrip('/')
+                self._read_body()
+                if self._inject_faults('GET', path):
+                    return
+                if path == '':
+                    return self._send(200, {'status': 'ok'})
+                if path == '/xapi/commands':
+                    return self._send(200, COMMANDS)
+                if path == f'/data/archive/projects/{fake.project}/experiments':
+                    columns = parse_qs(urlparse(self.path).query).get('columns', [''])[0].split(',')
+                    return self._send(200, {'ResultSet': {'Result': fake.experiment_rows(columns)}})
+                match = re.fullmatch(rf'/data/archive/projects/{re.escape(fake.project)}/experiments/([^/]+)', path)
+                if match is not None:
+                    experiment_id = fake.experiment_id(match.group(1))
+                    if experiment_id is None:
+                        return self._send(404, {'error': f'Experiment {match.group(1)} not found'})
+                    return self._send(200, fake.experiment_json(experiment_id))
+                match = re.fullmatch(rf'/data/archive/projects/{re.escape(fake.project)}/experiments/([^/]+)/scans/'
+                                     r'([^/]+)/resources', path)
+                if match is not None:
+                    with fake.lock:
+                        labels = fake.resources.get((fake.experiment_id(match.group(1)), match.group(2)))
+                    if labels is None:
+                        return self._send(404, {'error': f'Scan {match.group(2)} not found'})
+                    return self._send(200, {'ResultSet': {'Result': [{'label': label} for label in labels]}})
+                if path == '/fake/launches':
+                    with fake.lock:
+                        return self._send(200, {'launches': fake.launches, 'bulk-launches': fake.bulk_launches})
+                if path == '/fake/stats':
+                    return self._send(200, fake.stats())
+                return self._send(404, {'error': f'No fake endpoint for GET {path}'})
+
+            def do_DELETE(self):
+                path = urlparse(self.path).path
+                self._read_body()
+                if self._inject_faults('DELETE', path):
+                    return
+                match = re.fullmatch(rf'/data/archive/projects/{re.escape(fake.project)}/experiments/([^/]+)/scans/'
+                                     r'([^/]+)/resources/([^/]+)', path)
+                if match is None:
+                    return self._send(404, {'error': f'No fake endpoint for DELETE {path}'})
+                experiment_id = fake.experiment_id(match.group(1))
+                if not fake.delete_resource(experiment_id, match.group(2), match.group(3)):
+                    return self._send(404, {'error': f'Resource {match.group(3)} not found'})
+                return self._send(200, {})
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                params = self._read_body()
+                if self._inject_faults('POST', path):
+                    return
+                match = re.fullmatch(rf'/xapi/projects/{re.escape(fake.project)}/wrappers/(\d+)/root/scan/'
+                                     r'(launch|bulklaunch)', path)
+                if match is None:
+                    return self._send(404, {'error': f'No fake endpoint for POST {path}'})
+                if match.group(2) == 'launch':
+                    return self._send(200, fake.launch(int(match.group(1)), params))
+                return self._send(200, fake.bulk_launch(int(match.group(1)), params))
+
+            # Apply injected latency and errors. Returns True if an error response was sent.
+            def _inject_faults(self, method, path):
+                status = fake.inject_faults(method, path)
+                if status is None:
+                    return False
+                self._send(status, {'error': f'Injected {status} for {method} {path}'})
+                return True
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                return json.loads(body) if body else {}
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode()
+                with fake.lock:
+                    fake.request_counts[(self.command, status)] += 1
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client timed out and closed the connection
+                    self.close_connection = True
+
+        return Handler
+
+
+# Return a map of experiment label to scan IDs from a classifier or launch CSV
+def read_experiment_scans(csv_file):
+    experiment_scans = {}
+    with open(csv_file, newline='') as f:
+        for row in csv.DictReader(f):
+            experiment_scans.setdefault(row['experiment'], {})[row['scan']] = None
+    return {label: list(scans) for label, scans in experiment_scans.items()}
+
+
+# Return a map of generated experiment labels (EXP0000, EXP0001, ...) to scan IDs (1, 2, ...)
+def generate_experiment_scans(experiments, scans_per_experiment):
+    return {f'EXP{index:04d}': [str(scan) for scan in range(1, scans_per_experiment + 1)]
+            for index in range(experiments)}
+
+
+# Split /archive/experiments/{experiment}/scans/{scan} into (experiment, scan)
+def parse_scan_uri(uri):
+    parts = uri.strip('/').split('/')
+    return (parts[2], parts[4]) if len(parts) == 5 else (None, None)
+
+
+def parse_command_line_parameters():
+    parser = argparse.ArgumentParser(description='Fake XNAT server for offline mri_reface launcher runs')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--project', default='Test', help='Project ID served by the fake XNAT')
+    parser.add_argument('--csv', help='CSV whose experiment and scan columns populate the project')
+    parser.add_argument('--experiments', type=int, default=10,
+                        help='Number of generated experiments (EXP0000, EXP0001, ...) if no CSV is given')
+    parser.add_argument('--scans_per_experiment', type=int, default=5,
+                        help='Number of generated scans (1, 2, ...) per experiment if no CSV is given')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many further seconds added at random')
+    parser.add_argument('--error_rate', type=float, default=0.0,
+                        help='Fraction of requests answered with --error_status')
+    parser.add_argument('--error_status', type=int, default=503, help='Status code of injected errors')
+    parser.add_argument('--stall_rate', type=float, default=0.0,
+                        help='Fraction of requests held for a further --stall_seconds, e.g. to trigger client timeouts')
+    parser.add_argument('--stall_seconds', type=float, default=0.0, help='Length of injected stalls')
+    parser.add_argument('--fault_pattern', default=None,
+                        help='Regular expression limiting injected latency and errors to matching paths')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducible fault injection')
+    return parser.parse_args()
+
+
+def main():
+    params = parse_command_line_parameters()
+    if params.csv:
+        experiment_scans = read_experiment_scans(params.csv)
+    else:
+        experiment_scans = generate_experiment_scans(params.experiments, params.scans_per_experiment)
+    fake = FakeXnat(params.project, experiment_scans, params.host, params.port, params.latency, params.jitter,
+                    params.error_rate, params.error_status, params.stall_rate, params.stall_seconds,
+                    params.fault_pattern, params.seed)
+    print(f"Fake XNAT serving project {params.project} with {len(experiment_scans)} experiments at {fake.url}",
+          flush=True)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.server.server_close()
+        print(f"Received {len(fake.launches)} launches in {len(fake.bulk_launches)} bulk requests.", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# Load test of mri_reface_launcher.py against tools/fake_xnat.py. Runs the launcher's metadata pass and launch
+# submission on thousands of generated scans for each requested concurrency, and reports submission throughput, the
+# latency distribution of individual requests, retries and failures as JSON.
+#
+# ~ Sample command:
+# python tools/launcher_load_test.py --scans 5000 --concurrency 1 8 32 --latency 0.02 --jitter 0.05 --error_rate 0.01
+# python tools/launcher_load_test.py --scans 5000 --bulk --bulk_chunk_size 100 --stall_rate 0.01 --stall_seconds 3 --timeout 2
+import argparse
+import contextlib
+import csv
+import io
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS, '..', 'workspace'))
+
+import mri_reface_launcher
+from LaunchLedger import LaunchLedger
+from XnatMetadata import XnatMetadata
+from fake_xnat import FakeXnat, generate_experiment_scans
+
+
+# Collects the latency and status of every response received by a requests session
+class RequestRecorder:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.lock = threading.Lock()
+
+    def hook(self, response, *args, **kwargs):
+        with self.lock:
+            self.latencies.append(response.elapsed.total_seconds())
+            self.statuses[f'{response.request.method} {response.status_code}'] += 1
+
+    def summary(self):
+        return {'requests': len(self.latencies), 'statuses': dict(sorted(self.statuses.items())),
+                'latency_seconds': latency_summary(self.latencies)}
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    return {'mean': round(sum(ordered) / len(ordered), 6),
+            **{f'p{percentile}': round(percentile_value(ordered, percentile), 6) for percentile in [50, 90, 99, 99.9]},
+            'max': round(ordered[-1], 6)}
+
+
+# Nearest-rank percentile of an ordered list
+def percentile_value(ordered, percentile):
+    return ordered[max(0, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+
+# Launcher parameters as parse_command_line_parameters would return them for this load test
+def launcher_params(params, fake, csv_file, ledger_file, concurrency):
+    return argparse.Namespace(
+        xnat_host=fake.url, xnat_user='admin', xnat_pass='admin', project=params.project, csv_input=csv_file,
+        xnat_scan_class_filename=os.path.basename(csv_file), command_wrapper_id=None, concurrency=concurrency,
+        retries=params.retries, retry_backoff=params.retry_backoff, timeout=params.timeout, bulk=params.bulk,
+        bulk_chunk_size=params.bulk_chunk_size, ledger=ledger_file, ignore_ledger=False, auto_memory=False,
+        memory_calibration=[], standard_memory_mb=8000, highmem_wrapper_id=None, dry_run=False, skip_refaced=False)
+
+
+# Run the launcher once against a fresh fake XNAT and return the measurements
+def run_launcher(params, experiment_scans, work_dir, concurrency):
+    fake = FakeXnat(params.project, experiment_scans, latency=params.latency, jitter=params.jitter,
+                    error_rate=params.error_rate, error_status=params.error_status, stall_rate=params.stall_rate,
+                    stall_seconds=params.stall_seconds, fault_pattern=params.fault_pattern, seed=params.seed).start()
+    csv_file = os.path.join(work_dir, 'scans.csv')
+    ledger_file = os.path.join(work_dir, f'ledger-{concurrency}.jsonl')
+    try:
+        launch_params = launcher_params(params, fake, csv_file, ledger_file, concurrency)
+        quiet = contextlib.nullcontext() if params.verbose else contextlib.redirect_stdout(io.StringIO())
+        with quiet:
+            session = mri_reface_launcher.start_xnat_session(launch_params)
+            launch_params.command_wrapper_id = mri_reface_launcher.get_wrapper_id(
+                session, fake.url, 'mri_reface', 'mri-reface-scan')
+            metadata = XnatMetadata(session, fake.url, params.project, concurrency=concurrency,
+                                    timeout=params.timeout)
+            metadata_recorder = RequestRecorder()
+            session.hooks['response'].append(metadata_recorder.hook)
+            start = time.perf_counter()
+            scans = mri_reface_launcher.getScans(session, launch_params, LaunchLedger(ledger_file), metadata)
+            metadata_seconds = time.perf_counter() - start
+
+            launch_recorder = RequestRecorder()
+            session.hooks['response'] = [launch_recorder.hook]
+            start = time.perf_counter()
+            if params.bulk:
+                results = mri_reface_launcher.bulk_launch_scans(session, launch_params, scans,
+                                                                LaunchLedger(ledger_file))
+            else:
+                results = mri_reface_launcher.launch_scans(session, launch_params, scans, LaunchLedger(ledger_file))
+            launch_seconds = time.perf_counter() - start
+        # Let stalled requests the launcher gave up on finish, so duplicate launches they cause are counted
+        fake.wait_idle(params.stall_seconds + params.latency + params.jitter + 5)
+        failures = len([error for scan, error in results if error is not None])
+        unknown = len([error for scan, error in results
+                       if isinstance(error, mri_reface_launcher.LaunchOutcomeUnknown)])
+        launched = len(results) - failures
+        return {
+            'concurrency': concurrency,
+            'metadata': dict(metadata_recorder.summary(), seconds=round(metadata_seconds, 3), scans=len(scans)),
+            'launch': dict(launch_recorder.summary(), seconds=round(launch_seconds, 3), launched=launched,
+                           failed=failures - unknown, unknown=unknown, scans_per_second=round(launched / launch_seconds, 1) if launch_seconds
+                           else None),
+            'server': fake.stats(),
+        }
+    finally:
+        fake.stop()
+
+
+def write_scan_csv(csv_file, experiment_scans):
+    with open(csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['experiment', 'scan'])
+        for experiment, scans in experiment_scans.items():
+            writer.writerows([experiment, scan] for scan in scans)
+
+
+def parse_command_line_parameters():
+    parser = argparse.ArgumentParser(description='Load test mri_reface_launcher.py against a fake XNAT')
+    parser.add_argument('--scans', type=int, default=2000, help='Number of scans to launch')
+    parser.add_argument('--scans_per_experiment', type=int, default=5, help='Scans per generated experiment')
+    parser.add_argument('--project', default='Test', help='Project ID served by the fake XNAT')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                        help='Launcher concurrency values to run, one run each')
+    parser.add_argument('--bulk', action='store_true', help='Submit scans through the bulk launch API')
+    parser.add_argument('--bulk_chunk_size', type=int, default=100, help='Number of scans per bulk launch request')
+    parser.add_argument('--retries', type=int, default=3, help='Launcher retries after a connection failure or 503')
+    parser.add_argument('--retry_backoff', type=float, default=0.1, help='Launcher retry backoff in seconds')
+    parser.add_argument('--timeout', type=float, default=10, help='Launcher request timeout in seconds')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds added to every fake XNAT response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many further seconds added at random')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests answered with an error')
+    parser.add_argument('--error_status', type=int, default=503, help='Status code of injected errors')
+    parser.add_argument('--stall_rate', type=float, default=0.0, help='Fraction of requests stalled')
+    parser.add_argument('--stall_seconds', type=float, default=0.0, help='Length of injected stalls')
+    parser.add_argument('--fault_pattern', default=None,
+                        help='Regular expression limiting injected latency and errors to matching paths')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for fault injection')
+    parser.add_argument('--output', default='launcher_load_test.json', help='JSON results file')
+    parser.add_argument('--verbose', action='store_true', help='Show the launcher output')
+    return parser.parse_args()
+
+
+def main():
+    params = parse_command_line_parameters()
+    experiments = math.ceil(params.scans / params.scans_per_experiment)
+    experiment_scans = generate_experiment_scans(experiments, params.scans_per_experiment)
+    # Trim the last experiment so exactly params.scans scans are launched
+    last = list(experiment_scans)[-1]
+    experiment_scans[last] = experiment_scans[last][:params.scans - (experiments - 1) * params.scans_per_experiment]
+
+    work_dir = tempfile.mkdtemp(prefix='mri_reface_load_test-')
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scans': params.scans,
+              'options': {key: value for key, value in vars(params).items() if key not in ['output', 'verbose']},
+              'runs': []}
+    try:
+        write_scan_csv(os.path.join(work_dir, 'scans.csv'), experiment_scans)
+        for concurrency in params.concurrency:
+            print(f"Launching {params.scans} scans with concurrency {concurrency}...", flush=True)
+            run = run_launcher(params, experiment_scans, work_dir, concurrency)
+            launch = run['launch']
+            print(f"  {launch['launched']} launched, {launch['failed']} failed, {launch['unknown']} unknown in {launch['seconds']} s "
+                  f"({launch['scans_per_second']} scans/s), {launch['requests']} requests, "
+                  f"p50 {launch['latency_seconds'].get('p50')} s, p99 {launch['latency_seconds'].get('p99')} s",
+                  flush=True)
+            report['runs'].append(run)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(params.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote load test results to {params.output}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import json
+import os
+import threading
+import time
+
+
+# Append-only JSONL record of mri_reface launches, keyed by scan URI (/archive/experiments/{id}/scans/{scan}). The last
+# line written for a scan is its current state, so an interrupted batch can be re-run without relaunching scans that
+# were already submitted or refaced. A launch whose response never arrived is recorded as unknown: XNAT may have
+# started the container, so it is not resent until checked and re-run with --ignore_ledger.
+class LaunchLedger:
+    SUBMITTED = 'submitted'
+    FAILED = 'failed'
+    FINISHED = 'finished'
+    UNKNOWN = 'unknown'
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.entries = self._read_ledger()
+        self.lock = threading.Lock()
+
+    def _read_ledger(self):
+        entries = {}
+        if not os.path.exists(self.file_path):
+            return entries
+        with open(self.file_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    entries[entry['uri']] = entry
+                except (ValueError, KeyError):
+                    # A partial last line from an interrupted run
+                    continue
+        return entries
+
+    # Return True if the scan was submitted, found refaced or possibly launched by an earlier run
+    def is_done(self, uri):
+        return self.status(uri) in [self.SUBMITTED, self.FINISHED, self.UNKNOWN]
+
+    def status(self, uri):
+        entry = self.entries.get(uri)
+        return entry['status'] if entry is not None else None
+
+    def record(self, uri, status, **details):
+        experiment, scan = parse_scan_uri(uri)
+        entry = {'uri': uri, 'experiment': experiment, 'scan': scan, 'status': status,
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        entry.update({key: value for key, value in details.items() if value is not None})
+        with self.lock:
+            with open(self.file_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.entries[uri] = entry
+
+
+# Split /archive/experiments/{experiment}/scans/{scan} into (experiment, scan)
+def parse_scan_uri(uri):
+    parts = uri.strip('/').split('/')
+    return parts[2], parts[4]
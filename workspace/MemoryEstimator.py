@@ -0,0 +1,94 @@
+import glob
+import json
+import os
+
+
+# Rows, columns and slices assumed for a modality when a series' own geometry is not known
+DEFAULT_GEOMETRY = {'CT': (512, 512, 300), 'MR': (256, 256, 176), 'MRI': (256, 256, 176), 'PET': (256, 256, 128)}
+FALLBACK_GEOMETRY = (512, 512, 300)
+
+
+# Estimates the peak memory of an mri_reface run from the size of its input volume, as
+# intercept_mb + mb_per_volume_mb * volume_mb, plus a safety margin. volume_mb is rows x columns x slices x bytes per
+# voxel. The defaults are starting values that keep a typical head CT (512 x 512 x 300, about 6300 MB) within the
+# standard 8000 MB wrapper; calibrate() fits both terms to the reface_metrics.json files of past runs, whose series
+# geometry and the peak RSS of the mri_reface process give one sample each.
+class MemoryEstimator:
+    DEFAULT_INTERCEPT_MB = 2500
+    DEFAULT_MB_PER_VOLUME_MB = 20
+
+    def __init__(self, intercept_mb=DEFAULT_INTERCEPT_MB, mb_per_volume_mb=DEFAULT_MB_PER_VOLUME_MB, margin=0.15):
+        self.intercept_mb = intercept_mb
+        self.mb_per_volume_mb = mb_per_volume_mb
+        self.margin = margin
+
+    # Fit intercept and slope by least squares over past runs. Falls back to the defaults if the records do not span
+    # at least two different volume sizes.
+    @classmethod
+    def calibrate(cls, records, margin=0.15):
+        samples = [(volume_mb(record['rows'], record['columns'], record['slices'], record.get('bits_allocated', 16)),
+                    mri_reface_peak_rss_mb(record)) for record in records]
+        if len({volume for volume, peak in samples}) < 2:
+            print(f"Not enough past runs to calibrate memory estimates ({len(samples)}), using defaults.", flush=True)
+            return cls(margin=margin)
+        mean_volume = sum(volume for volume, peak in samples) / len(samples)
+        mean_peak = sum(peak for volume, peak in samples) / len(samples)
+        slope = sum((volume - mean_volume) * (peak - mean_peak) for volume, peak in samples) \
+            / sum((volume - mean_volume) ** 2 for volume, peak in samples)
+        slope = max(slope, 0)
+        intercept = mean_peak - slope * mean_volume
+        print(f"Calibrated memory estimate from {len(samples)} runs: {intercept:.0f} MB + "
+              f"{slope:.1f} x volume MB.", flush=True)
+        return cls(intercept, slope, margin)
+
+    def estimate_mb(self, rows, columns, slices, bits_allocated=16):
+        volume = volume_mb(rows, columns, slices, bits_allocated)
+        return (self.intercept_mb + self.mb_per_volume_mb * volume) * (1 + self.margin)
+
+    # Estimate from a ScanClassifierCSV ScanRecord and the scan's slice count, such as the frame count XNAT lists for
+    # it. Rows and columns come from the modality defaults. Without a slice count, a CSV with one row per file gives
+    # it as the file count; a CSV with one row per scan leaves the modality default.
+    def estimate_scan_mb(self, record, slices=None):
+        modality = record.modality if record is not None else ''
+        rows, columns, default_slices = DEFAULT_GEOMETRY.get(modality, FALLBACK_GEOMETRY)
+        if slices is None:
+            slices = record.file_count if record is not None and record.file_count > 1 else default_slices
+        return self.estimate_mb(rows, columns, slices)
+
+
+def volume_mb(rows, columns, slices, bits_allocated=16):
+    return rows * columns * slices * max(bits_allocated // 8, 1) / (1024 * 1024)
+
+
+# Read past run metrics from reface_metrics.json files, directories searched for them, or JSONL files with one
+# metrics record per line. Only runs whose mri_reface stage succeeded and recorded its own peak memory, and whose
+# geometry is known, are returned.
+def read_calibration_records(paths):
+    records = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = glob.glob(os.path.join(path, '**', 'reface_metrics*.json'), recursive=True)
+        else:
+            files = [path]
+        for file_path in files:
+            with open(file_path) as f:
+                if file_path.endswith('.jsonl'):
+                    records.extend(json.loads(line) for line in f if line.strip())
+                else:
+                    records.append(json.load(f))
+    return [record for record in records if is_calibration_record(record)]
+
+
+def is_calibration_record(record):
+    if not all(record.get(key) for key in ['rows', 'columns', 'slices']):
+        return False
+    return mri_reface_peak_rss_mb(record) is not None
+
+
+# Return the peak RSS in MB of the successful mri_reface run of a metrics record, or None. The record's top-level
+# children_peak_rss_mb is not used: in session mode it is a high-water mark over every scan run in the container so far.
+def mri_reface_peak_rss_mb(record):
+    for stage in record.get('stages', []):
+        if stage['name'] == 'mri_reface' and stage['status'] == 'ok' and stage.get('returncode') == 0:
+            return stage.get('process_peak_rss_mb') or None
+    return None
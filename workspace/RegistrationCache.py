@@ -0,0 +1,60 @@
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+# Content-addressed store of mri_reface affine registrations, so a series refaced again (after --delete_existing, a
+# failed upload or a change of output options) can pass -regFile instead of re-running reg_aladin. Keys combine the
+# pixel data digest of the series with the imType and any options that change the registration; entries are kept as
+# <cache_dir>/<key[:2]>/<key><ext>, where ext is that of the registration file mri_reface wrote (.txt or .mat).
+class RegistrationCache:
+    # mri_reface options that change the registration it computes
+    REGISTRATION_OPTS = ['-altReg']
+
+    def __init__(self, cache_dir, pattern):
+        self.cache_dir = cache_dir
+        self.pattern = pattern
+
+    def key(self, pixel_digests, scan_type, mri_reface_opts=None):
+        digest = hashlib.sha256()
+        # Sorted, so the key does not depend on file names or the order they are listed in
+        for pixel_digest in sorted(pixel_digests):
+            digest.update(pixel_digest.encode())
+        digest.update(f'imType={scan_type}'.encode())
+        opts = mri_reface_opts.split() if mri_reface_opts else []
+        for index, opt in enumerate(opts[:-1]):
+            if opt in self.REGISTRATION_OPTS:
+                digest.update(f'{opt}={opts[index + 1]}'.encode())
+        return digest.hexdigest()
+
+    # Return the cached registration file for key, or None
+    def lookup(self, key):
+        matches = glob.glob(os.path.join(self.cache_dir, key[:2], f'{key}.*'))
+        return matches[0] if matches else None
+
+    # Copy the registration mri_reface wrote to output_dir into the cache under key. Returns the cached path, or None
+    # if output_dir does not contain exactly one file matching the registration pattern.
+    def store(self, key, output_dir):
+        matches = glob.glob(os.path.join(output_dir, self.pattern))
+        if len(matches) != 1:
+            print(f"Not caching registration: expected one file matching {self.pattern} in {output_dir}, "
+                  f"found {len(matches)}.", flush=True)
+            return None
+        entry_dir = os.path.join(self.cache_dir, key[:2])
+        os.makedirs(entry_dir, exist_ok=True)
+        cached_file = os.path.join(entry_dir, key + os.path.splitext(matches[0])[1])
+        # Copy to a temporary file first so concurrent containers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=entry_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as out, open(matches[0], 'rb') as f:
+                shutil.copyfileobj(f, out)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, cached_file)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        print(f"Cached registration {matches[0]} as {cached_file}", flush=True)
+        return cached_file
+
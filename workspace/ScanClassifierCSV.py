@@ -1,35 +1,177 @@
 import csv
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+
+
+# One scan of the classifier CSV. The CSV has one row per file; rows of the same scan are collapsed into a single
+# record holding the first row's values and the number of files seen.
+class ScanRecord:
+    __slots__ = ['experiment', 'scan', 'label', 'modality', 'body_part', 'radiopharmaceutical', 'file_count']
+
+    def __init__(self, experiment, scan, label, modality, body_part, radiopharmaceutical):
+        self.experiment = experiment
+        self.scan = scan
+        self.label = label
+        self.modality = modality
+        self.body_part = body_part
+        self.radiopharmaceutical = radiopharmaceutical
+        self.file_count = 1
+
+    def __repr__(self):
+        return (f"ScanRecord({self.experiment}, {self.scan}, label={self.label}, modality={self.modality}, "
+                f"body_part={self.body_part}, radiopharmaceutical={self.radiopharmaceutical}, "
+                f"files={self.file_count})")
 
 
 class ScanClassifierCSV:
-    def __init__(self, file_path):
+    # Bumped whenever the cache layout or the parsed representation changes
+    CACHE_VERSION = 1
+    # Body parts, lower case, of scans that can be refaced
+    HEAD_BODY_PARTS = ['head', 'brain', 'neuro', 'na', '']
+
+    # If experiment and scan are given, loading stops once that scan's rows have been read. If cache is True, the
+    # parsed CSV is loaded from, or saved to, a sidecar cache file next to the CSV.
+    def __init__(self, file_path, experiment=None, scan=None, cache=True):
         self.file_path = file_path
-        self.data = self._read_csv()
-        self.header = self.data[0]
         self.scan_row = None
+        self.header = []
+        self.index = {}
+        if cache:
+            cache_path = self._cache_path()
+            if self._load_cache(cache_path):
+                return
+            if os.access(os.path.dirname(cache_path), os.W_OK):
+                # Parse the whole CSV so the cache serves every scan on later launches
+                self._read_csv()
+                self._save_cache(cache_path)
+                return
+        self._read_csv(experiment, scan)
+
+    def _cache_path(self):
+        directory, filename = os.path.split(os.path.abspath(self.file_path))
+        return os.path.join(directory, f'.{filename}.index')
 
-    def _read_csv(self):
+    def _content_hash(self):
+        digest = hashlib.sha256()
+        with open(self.file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # The cache is valid if the CSV has the recorded size and either the recorded modification time or, when the
+    # file has been copied or touched since, the recorded content hash
+    def _load_cache(self, cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cache = json.loads(zlib.decompress(f.read()))
+            stat = os.stat(self.file_path)
+            if cache['version'] != self.CACHE_VERSION or cache['size'] != stat.st_size:
+                return False
+            restamp = cache['mtime'] != stat.st_mtime_ns
+            if restamp and cache['sha256'] != self._content_hash():
+                return False
+            self.header = cache['header']
+            self.body_part_column, self.modality_column, self.radio_pharmaceutical_column = cache['columns']
+            self.attributes = cache['attributes']
+            for values in cache['records']:
+                record = ScanRecord(*values[:-1])
+                record.file_count = values[-1]
+                self.index[(record.experiment, record.scan)] = record
+        except (OSError, ValueError, KeyError, TypeError, zlib.error):
+            self.header, self.index = [], {}
+            return False
+        print(f"Loaded scan classification index from {cache_path}.", flush=True)
+        if restamp:
+            # Record the new modification time so later launches skip hashing the CSV again
+            self._save_cache(cache_path, cache['sha256'])
+        return True
+
+    # Write the cache atomically; a read-only or shared directory is not an error. sha256 is the CSV content hash, if
+    # already known.
+    def _save_cache(self, cache_path, sha256=None):
+        temp_path = None
+        try:
+            stat = os.stat(self.file_path)
+            cache = {'version': self.CACHE_VERSION,
+                     'size': stat.st_size,
+                     'mtime': stat.st_mtime_ns,
+                     'sha256': sha256 or self._content_hash(),
+                     'header': self.header,
+                     'columns': [self.body_part_column, self.modality_column, self.radio_pharmaceutical_column],
+                     'attributes': self.attributes,
+                     'records': [[record.experiment, record.scan, record.label, record.modality, record.body_part,
+                                  record.radiopharmaceutical, record.file_count] for record in self.index.values()]}
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(json.dumps(cache, separators=(',', ':')).encode()))
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"Could not write scan classification index {cache_path}: {e}", flush=True)
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    # Stream the CSV, keeping only the columns get_im_type needs and one ScanRecord per (experiment, scan)
+    def _read_csv(self, experiment=None, scan=None):
         with open(self.file_path, newline='') as csvfile:
             reader = csv.reader(csvfile)
-            return list(reader)
+            self.header = next(reader, [])
+            columns = {label: index for index, label in reversed(list(enumerate(self.header)))}
+            self.body_part_column = '0018_0015' if '0018_0015' in columns else 'BodyPartExamined'
+            self.modality_column = '0008_0060' if '0008_0060' in columns else 'Modality'
+            self.radio_pharmaceutical_column = '0054_0016' if '0054_0016' in columns else 'Radiopharmaceutical'
+            # Record attribute holding each column get_im_type reads, for the columns present in the header
+            self.attributes = {column_label: attribute for column_label, attribute in
+                               [('labels1', 'label'), (self.modality_column, 'modality'),
+                                (self.body_part_column, 'body_part'),
+                                (self.radio_pharmaceutical_column, 'radiopharmaceutical')]
+                               if column_label in columns}
+            if 'experiment' not in columns or 'scan' not in columns:
+                return
+            positions = [columns.get(column_label) for column_label in
+                         ['experiment', 'scan', 'labels1', self.modality_column, self.body_part_column,
+                          self.radio_pharmaceutical_column]]
+            target = (experiment, scan) if experiment is not None and scan is not None else None
+
+            for row in reader:
+                values = [row[position] if position is not None and position < len(row) else ''
+                          for position in positions]
+                key = (values[0], values[1])
+                if target is not None and key != target:
+                    if target in self.index:
+                        # Rows of a scan are contiguous, so the requested scan is complete
+                        return
+                    continue
+                record = self.index.get(key)
+                if record is None:
+                    self.index[key] = ScanRecord(*values)
+                else:
+                    record.file_count += 1
 
     def _find_scan_row(self, experiment, scan):
-        if len(self.data) > 1:
-            for row_index in range(len(self.data)):
-                if self._get_value('experiment', row_index) == experiment \
-                        and self._get_value('scan', row_index) == scan:
-                    return row_index
-        else:
-            # If there is only one row of data, assume this is the matching row
-            return 1
-        return None
+        return self.index.get((experiment, scan))
 
-    def _get_value(self, column_label, row_number):
-        if column_label in self.header:
-            return self.data[row_number][self.header.index(column_label)]
+    def _get_value(self, column_label, scan_row):
+        if column_label in self.attributes:
+            return getattr(scan_row, self.attributes[column_label])
         else:
             raise ValueError(f"Label {column_label} not found in header.")
 
+    # Return the (experiment, scan) pairs in the CSV, in the order they first appear
+    def scans(self):
+        return list(self.index)
+
+    # Return True if the CSV has the columns needed to classify scans, rather than just experiment and scan
+    def can_classify(self):
+        return self.body_part_column in self.attributes and self.modality_column in self.attributes
+
+    # Return the ScanRecord of a scan, or None if it is not in the CSV
+    def get_scan(self, experiment, scan):
+        return self.index.get((experiment, scan))
+
     # Return mri_reface compatible imType: T1|T2|FLAIR|FDG|PIB|FBP|TAU|CT
 #     Hierarchy of imtype
 #       Body part:
@@ -48,24 +190,40 @@ class ScanClassifierCSV:
 #               Imtype t2 = contains t2 but not flair
 #               Imtype T1 = contains T1, mprage
     def get_im_type(self, experiment, scan):
-        im_type = None
         print(f"Finding scan {scan} in experiment {experiment}.")
         self.scan_row = self._find_scan_row(experiment, scan)
-        body_part_column = '0018_0015' if '0018_0015' in self.header else 'BodyPartExamined'
-        print(f"Body part column: {body_part_column}")
-        modality_column = '0008_0060' if '0008_0060' in self.header else 'Modality'
-        print(f"Modality column: {modality_column}")
-        radio_pharmaceutical_column = '0054_0016' if '0054_0016' in self.header else 'Radiopharmaceutical'
-        print(f"RadioPharmaceutical column: {radio_pharmaceutical_column}")
+        print(f"Body part column: {self.body_part_column}")
+        print(f"Modality column: {self.modality_column}")
+        print(f"RadioPharmaceutical column: {self.radio_pharmaceutical_column}")
         print(f"Scan row: {self.scan_row}")
-        if self.scan_row is not None:
-            if self._get_value(body_part_column, self.scan_row).lower() in ['head', 'brain', 'neuro', 'na', '']:
-                if self._get_value(modality_column, self.scan_row) == 'CT':
-                    print(f"Found CT Modality.", flush=True)
+        im_type = self._classify(self.scan_row, experiment, scan, verbose=True)
+        print(f"Found mri_reface imType: {im_type}")
+        return im_type
+
+    # Return the imType of many (experiment, scan) pairs in one call, as a dict keyed by (experiment, scan). Scans that
+    # cannot be refaced are left out; if errors is given, their error messages are added to it under the same key.
+    def get_im_types(self, scans, errors=None):
+        im_types = {}
+        for experiment, scan in scans:
+            try:
+                im_types[(experiment, scan)] = self._classify(self._find_scan_row(experiment, scan), experiment, scan)
+            except ValueError as e:
+                if errors is not None:
+                    errors[(experiment, scan)] = str(e)
+        return im_types
+
+    def _classify(self, scan_row, experiment, scan, verbose=False):
+        im_type = None
+        if scan_row is not None:
+            if self._get_value(self.body_part_column, scan_row).lower() in self.HEAD_BODY_PARTS:
+                if self._get_value(self.modality_column, scan_row) == 'CT':
+                    if verbose:
+                        print(f"Found CT Modality.", flush=True)
                     im_type = 'CT'
-                elif self._get_value(modality_column, self.scan_row) == 'PET':
-                    print(f"Found PET Modality.", flush=True)
-                    radiopharmaceutical = self._get_value(radio_pharmaceutical_column, self.scan_row)
+                elif self._get_value(self.modality_column, scan_row) == 'PET':
+                    if verbose:
+                        print(f"Found PET Modality.", flush=True)
+                    radiopharmaceutical = self._get_value(self.radio_pharmaceutical_column, scan_row)
                     if radiopharmaceutical in ['Amyloid', 'PIB', 'AV45', 'florbetapir', 'AV-45']:
                         im_type = 'PIB'
                     elif radiopharmaceutical.lower() in ['fdg']:
@@ -74,10 +232,12 @@ class ScanClassifierCSV:
                         im_type = 'TAU'
                     else:
                         raise ValueError(f"PET Radiopharmaceutical {radiopharmaceutical} not supported.")
-                elif self._get_value(modality_column, self.scan_row) in ['MRI', 'MR']:
-                    print(f"Found MRI/MR Modality.", flush=True)
-                    label = self._get_value('labels1', self.scan_row)
-                    print(f"labels1: {label}")
+                elif self._get_value(self.modality_column, scan_row) in ['MRI', 'MR']:
+                    if verbose:
+                        print(f"Found MRI/MR Modality.", flush=True)
+                    label = self._get_value('labels1', scan_row)
+                    if verbose:
+                        print(f"labels1: {label}")
                     im_type = 'FLAIR'
                     if 't2' in label.lower() and 'flair' not in label.lower():
                         im_type = 'T2'
@@ -87,12 +247,10 @@ class ScanClassifierCSV:
                         im_type = 'OT'
                         raise ValueError(f"Scan {scan} in experiment {experiment} has OT label. Reface not supported.")
             else:
-                raise ValueError(f"Body part {self._get_value(body_part_column, self.scan_row)} not supported.")
+                raise ValueError(f"Body part {self._get_value(self.body_part_column, scan_row)} not supported.")
         else:
             raise ValueError(f"Scan: {scan} and experiment: {experiment} not found in CSV: {self.file_path}.")
         if im_type is None:
             raise ValueError(f"Imtype not found for scan {scan} in experiment {experiment}.")
-
-        print(f"Found mri_reface imType: {im_type}")
         return im_type
 
@@ -0,0 +1,107 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Per-stage wall time, CPU time, files and bytes processed, and peak memory of an xnat_reface run, written as JSON.
+# Peak RSS values come from getrusage and are high-water marks for the run so far: peak_rss_mb for this process and
+# children_peak_rss_mb for the largest finished child process. Pool workers are started by a fork server, so they are
+# not children of this process; run_pool reports their usage with add_worker_usage, and a stage's cpu_seconds includes
+# the worker_cpu_seconds of the tasks it ran, with worker_peak_rss_mb the largest worker.
+class StageMetrics:
+    def __init__(self, **run_info):
+        self.run_info = run_info
+        self.stages = []
+        self.start_time = time.time()
+
+    # Time the enclosed block. The yielded dict can be given 'files', 'bytes' or any other JSON values to record.
+    @contextmanager
+    def stage(self, name):
+        record = {'name': name, 'status': 'ok'}
+        outer_record = getattr(open_stages, 'record', None)
+        open_stages.record = record
+        start_wall = time.monotonic()
+        start_cpu = cpu_seconds()
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            open_stages.record = outer_record
+            record['wall_seconds'] = round(time.monotonic() - start_wall, 3)
+            record['cpu_seconds'] = round(cpu_seconds() - start_cpu + record.get('worker_cpu_seconds', 0), 3)
+            record['peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_SELF)
+            record['children_peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+            self.stages.append(record)
+            print(f"Stage {name}: {record['wall_seconds']} s, {record.get('files', 0)} files, "
+                  f"{record.get('bytes', 0)} bytes, peak RSS {record['peak_rss_mb']} MB "
+                  f"(children {record['children_peak_rss_mb']} MB)", flush=True)
+
+    def to_dict(self):
+        return dict(self.run_info,
+                    wall_seconds=round(time.time() - self.start_time, 3),
+                    peak_rss_mb=peak_rss_mb(resource.RUSAGE_SELF),
+                    children_peak_rss_mb=peak_rss_mb(resource.RUSAGE_CHILDREN),
+                    stages=self.stages)
+
+    def write(self, file_path):
+        try:
+            with open(file_path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2, default=str)
+            print(f"Wrote stage metrics to {file_path}", flush=True)
+        except OSError as e:
+            print(f"Could not write stage metrics to {file_path}: {e}", flush=True)
+
+
+# The stage open in each thread, which the usage of pool workers started from that thread is added to. In session mode
+# the next scan is prepared in another thread while mri_reface runs.
+open_stages = threading.local()
+
+
+# Add the CPU seconds and peak RSS of pool worker processes to the stage open in the calling thread, if any
+def add_worker_usage(worker_cpu_seconds, worker_peak_rss_mb):
+    record = getattr(open_stages, 'record', None)
+    if record is None:
+        return
+    record['worker_cpu_seconds'] = round(record.get('worker_cpu_seconds', 0) + worker_cpu_seconds, 3)
+    record['worker_peak_rss_mb'] = max(record.get('worker_peak_rss_mb', 0), worker_peak_rss_mb)
+
+
+# User and system CPU time of this process and its finished children
+def cpu_seconds():
+    return usage_cpu_seconds(resource.getrusage(resource.RUSAGE_SELF)) \
+        + usage_cpu_seconds(resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+def usage_cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb(who):
+    return usage_peak_rss_mb(resource.getrusage(who))
+
+
+# Peak RSS in MB of a getrusage or os.wait4 result
+def usage_peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return round(usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+# Return the number of files under path and their total size in bytes, skipping the exclude directory
+def directory_usage(path, exclude=None):
+    files, size = 0, 0
+    for root, dirs, names in os.walk(path):
+        if exclude is not None:
+            dirs[:] = [name for name in dirs if os.path.join(root, name) != exclude]
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                continue
+    return files, size
@@ -0,0 +1,82 @@
+import re
+
+from pydicom.datadict import dictionary_VR
+from pydicom.tag import Tag
+
+
+# A DicomEdit-style tag edit script, such as delete-dicom-protocol/remove-protocol-name.txt, compiled once and applied
+# to parsed DICOM datasets. Supported statements, one per line, with // comments and blank lines ignored:
+#   version "6.6"               script language version, recorded but not checked
+#   -(0018,1030)                delete the element
+#   (0010,0010) := "value"      set the element, adding it with its dictionary VR if it is missing
+class TagEditScript:
+    TAG_PATTERN = r'\(\s*([0-9A-Fa-f]{4})\s*,\s*([0-9A-Fa-f]{4})\s*\)'
+    STRING_PATTERN = r'"((?:[^"\\]|\\.)*)"'
+    DELETE = 'delete'
+    ASSIGN = 'assign'
+
+    def __init__(self, text, source='<script>'):
+        self.source = source
+        self.version = None
+        # (operation, tag, value) in script order
+        self.operations = []
+        for line_number, line in enumerate(text.splitlines(), 1):
+            statement = strip_comment(line).strip()
+            if statement:
+                self._compile(statement, line_number)
+
+    @classmethod
+    def from_file(cls, file_path):
+        with open(file_path) as f:
+            return cls(f.read(), file_path)
+
+    def _compile(self, statement, line_number):
+        match = re.fullmatch(rf'version\s+{self.STRING_PATTERN}', statement)
+        if match is not None:
+            self.version = match.group(1)
+            return
+        match = re.fullmatch(rf'-\s*{self.TAG_PATTERN}', statement)
+        if match is not None:
+            self.operations.append((self.DELETE, Tag(int(match.group(1), 16), int(match.group(2), 16)), None))
+            return
+        match = re.fullmatch(rf'{self.TAG_PATTERN}\s*:=\s*{self.STRING_PATTERN}', statement)
+        if match is not None:
+            tag = Tag(int(match.group(1), 16), int(match.group(2), 16))
+            try:
+                dictionary_VR(tag)
+            except KeyError:
+                raise ValueError(f'{self.source} line {line_number}: {tag} is not in the DICOM dictionary, '
+                                 f'so its VR is unknown.')
+            self.operations.append((self.ASSIGN, tag, re.sub(r'\\(.)', r'\1', match.group(3))))
+            return
+        raise ValueError(f'{self.source} line {line_number}: unsupported statement: {statement}')
+
+    # Apply the script to a parsed dataset in place
+    def apply(self, dicom):
+        for operation, tag, value in self.operations:
+            if operation == self.DELETE:
+                if tag in dicom:
+                    del dicom[tag]
+            elif tag in dicom:
+                dicom[tag].value = value
+            else:
+                dicom.add_new(tag, dictionary_VR(tag), value)
+
+    def __repr__(self):
+        return f"TagEditScript({self.source}, version={self.version}, operations={len(self.operations)})"
+
+
+# Return line with any // comment outside a quoted string removed
+def strip_comment(line):
+    in_string = False
+    escaped = False
+    for index, char in enumerate(line):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            in_string = not in_string
+        elif not in_string and line.startswith('//', index):
+            return line[:index]
+    return line
@@ -0,0 +1,149 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Project metadata fetched from the XNAT REST API in bulk and cached for ttl seconds. Experiments and the IDs of their
+# scans come from a single project listing with scan columns; the resource labels of an experiment's scans need one
+# query per experiment, which can be prefetched concurrently. Shared by mri_reface_launcher.py and xnat_reface.py.
+class XnatMetadata:
+    def __init__(self, session, host, project, ttl=300, concurrency=8, timeout=60):
+        self.session = session
+        self.host = host.rstrip('/')
+        self.project = project
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def _cached(self, key, fetch):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        value = fetch()
+        with self.lock:
+            self.cache[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, experiment=None):
+        with self.lock:
+            if experiment is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(('scans', experiment), None)
+                self.cache.pop(('listing',), None)
+
+    def _get(self, url, **kwargs):
+        response = self.session.get(url, timeout=self.timeout, **kwargs)
+        if response.status_code != 200:
+            raise Exception(f'Failed to get {url} from XNAT at {self.host} with status code {response.status_code}')
+        return response.json()
+
+    # Return the project's experiment listing, one row per scan, as (experiment ID, label, scan ID, frames) with a scan
+    # ID of None for experiments without scans and frames None where XNAT does not know the scan's frame count, and
+    # whether the server included the scan ID column at all
+    def _project_listing(self):
+        def fetch():
+            url = f'{self.host}/data/archive/projects/{self.project}/experiments'
+            columns = f'ID,label,{SCAN_ID_COLUMN},{SCAN_FRAMES_COLUMN}'
+            results = self._get(url, params={'format': 'json', 'columns': columns})['ResultSet']['Result']
+            return ([(row['ID'], row['label'], row.get(SCAN_ID_COLUMN) or None,
+                      parse_frames(row.get(SCAN_FRAMES_COLUMN))) for row in results],
+                    any(SCAN_ID_COLUMN in row for row in results))
+        return self._cached(('listing',), fetch)
+
+    # Return a map of experiment label to experiment ID for the project
+    def experiments(self):
+        rows, has_scans = self._project_listing()
+        return {label: experiment_id for experiment_id, label, scan, frames in rows}
+
+    # Return a map of experiment ID to the set of its scan IDs, for the whole project in one query, or None if the server
+    # left the scan ID column out of the listing, in which case scans(experiment) has to be used instead
+    def project_scans(self):
+        rows, has_scans = self._project_listing()
+        if not has_scans:
+            return None
+        project_scans = {}
+        for experiment_id, label, scan, frames in rows:
+            scans = project_scans.setdefault(experiment_id, set())
+            if scan is not None:
+                scans.add(scan)
+        return project_scans
+
+    # Return a map of (experiment ID, scan ID) to the scan's frame (slice) count, for the scans whose count XNAT knows
+    def scan_frames(self):
+        rows, has_scans = self._project_listing()
+        return {(experiment_id, scan): frames for experiment_id, label, scan, frames in rows
+                if scan is not None and frames is not None}
+
+    # Return a map of scan ID to resource labels for an experiment, given by label or ID
+    def scans(self, experiment):
+        def fetch():
+            url = f'{self.host}/data/archive/projects/{self.project}/experiments/{experiment}'
+            return parse_experiment_scans(self._get(url, params={'format': 'json'}))
+        return self._cached(('scans', experiment), fetch)
+
+    # Fetch the scans of many experiments concurrently. Returns a map of experiment to its scans, or to the exception
+    # raised while fetching them.
+    def prefetch(self, experiments):
+        def fetch(experiment):
+            try:
+                return self.scans(experiment)
+            except Exception as e:
+                return e
+        experiments = list(dict.fromkeys(experiments))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return dict(zip(experiments, executor.map(fetch, experiments)))
+
+    # experiment is given by label or ID
+    def scan_exists(self, experiment, scan):
+        project_scans = self.project_scans()
+        if project_scans is None:
+            return scan in self.scans(experiment)
+        experiment_id = self.experiments().get(experiment, experiment)
+        return scan in project_scans.get(experiment_id, ())
+
+    def resources(self, experiment, scan):
+        return self.scans(experiment).get(scan, [])
+
+    def delete_resource(self, experiment, scan, resource):
+        url = f'{self.host}/data/archive/projects/{self.project}/experiments/{experiment}/scans/{scan}/resources/{resource}'
+        response = self.session.delete(url, params={'removeFiles': 'true'}, timeout=self.timeout)
+        self.invalidate(experiment)
+        if response.status_code != 200:
+            raise Exception(f'Failed to delete resource {resource} with status code {response.status_code}')
+
+
+# Listing column holding scan IDs, which makes the experiment listing return one row per scan
+SCAN_ID_COLUMN = 'xnat:imagescandata/id'
+# Listing column holding the number of frames XNAT counted in each scan
+SCAN_FRAMES_COLUMN = 'xnat:imagescandata/frames'
+
+
+# Return a listing frame count as a positive int, or None if it is missing or empty
+def parse_frames(value):
+    try:
+        frames = int(value)
+    except (TypeError, ValueError):
+        return None
+    return frames if frames > 0 else None
+
+
+# Extract {scan ID: [resource labels]} from the JSON representation of an XNAT image session
+def parse_experiment_scans(experiment_json):
+    scans = {}
+    for item in experiment_json.get('items', []):
+        for child in item.get('children', []):
+            if child.get('field') != 'scans/scan':
+                continue
+            for scan in child.get('items', []):
+                labels = []
+                for scan_child in scan.get('children', []):
+                    if scan_child.get('field') == 'file':
+                        labels.extend(resource.get('data_fields', {}).get('label')
+                                      for resource in scan_child.get('items', []))
+                scans[scan.get('data_fields', {}).get('ID')] = labels
+    return scans
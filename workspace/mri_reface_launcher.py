@@ -1,10 +1,26 @@
 # Launch the mri_reface command on a remote XNAT
 import argparse
 import csv
+import json
 import sys
 import time
 import getpass
+from collections import Counter
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from LaunchLedger import LaunchLedger, parse_scan_uri
+from MemoryEstimator import MemoryEstimator, read_calibration_records
+from ScanClassifierCSV import ScanClassifierCSV
+from XnatMetadata import XnatMetadata
+
+
+# Raised when a launch request may have reached XNAT but no response arrived, e.g. on a read timeout. The launch may
+# have started a container, so it must not be resent blindly.
+class LaunchOutcomeUnknown(Exception):
+    pass
 
 
 # ~ Sample launch command:
@@ -22,13 +38,36 @@ def main():
         if not params.command_wrapper_id:
             params.command_wrapper_id = get_wrapper_id(xnat_session, params.xnat_host, "mri_reface", "mri-reface-scan")
 
-        # Get scans from CSV
-        scans = getScans(xnat_session, params)
+        # Record launches so an interrupted batch can be resumed
+        ledger = LaunchLedger(params.ledger)
+
+        # Cache project metadata for the rest of the run
+        metadata = XnatMetadata(xnat_session, params.xnat_host, params.project, concurrency=params.concurrency,
+                                timeout=params.timeout)
 
-        for scan in scans:
-            print(f"Launching mri_reface on {scan}...", flush=True)
-            # Launch mri_reface on xnat
-            launch_command_wrapper(xnat_session, params, scan)
+        # Get scans from CSV
+        scans = getScans(xnat_session, params, ledger, metadata)
+
+        # Route each scan to the standard or high memory wrapper
+        if params.auto_memory:
+            wrapper_scans = assign_wrappers(xnat_session, params, scans, metadata)
+        else:
+            wrapper_scans = {params.command_wrapper_id: scans}
+
+        if params.dry_run:
+            print(f"Dry run: {len(scans)} scans would be launched.", flush=True)
+            return
+
+        # Launch mri_reface on xnat
+        results = []
+        for wrapper_id, scans in wrapper_scans.items():
+            if params.bulk:
+                results.extend(bulk_launch_scans(xnat_session, params, scans, ledger, wrapper_id))
+            else:
+                results.extend(launch_scans(xnat_session, params, scans, ledger, wrapper_id))
+        failures = [scan for scan, error in results if error is not None]
+        if failures:
+            sys.exit(f'Failed to launch mri_reface on {len(failures)} of {len(results)} scans.')
 
     except csv.Error as e:
         sys.exit(f'Error parsing CSV file: {e}')
@@ -36,14 +75,152 @@ def main():
         sys.exit(f'Error launching mri_reface: {e}')
 
 
-def launch_command_wrapper(xnat_session, params, scan):
-    launch_string = f'{params.xnat_host}/xapi/projects/{params.project}/wrappers/{params.command_wrapper_id}/root/scan/launch'
-    response = xnat_session.post(launch_string,
-                                 json={'scan': scan,
-                                       'scan-class-file': '/archive/projects/'+params.project+'/resources/DICOM_LM_CLASSIFIER_OUTPUT/files/' + params.xnat_scan_class_filename})
+# Launch mri_reface on every scan using up to params.concurrency concurrent requests. A failed launch does not stop the
+# remaining scans. Returns a list of (scan, error) in scan order, where error is None for successful launches.
+# Each outcome is recorded in ledger, if given. wrapper_id defaults to params.command_wrapper_id.
+def launch_scans(xnat_session, params, scans, ledger=None, wrapper_id=None):
+    wrapper_id = wrapper_id or params.command_wrapper_id
+
+    def launch(scan):
+        print(f"Launching mri_reface on {scan}...", flush=True)
+        try:
+            report = launch_command_wrapper(xnat_session, params, scan, wrapper_id)
+            if ledger is not None:
+                ledger.record(scan, LaunchLedger.SUBMITTED, wrapper_id=wrapper_id,
+                              container_id=report.get('container-id'), workflow_id=report.get('workflow-id'))
+            return scan, None
+        except LaunchOutcomeUnknown as e:
+            print(f"Unknown outcome launching mri_reface on {scan}: {e}", flush=True)
+            if ledger is not None:
+                ledger.record(scan, LaunchLedger.UNKNOWN, wrapper_id=wrapper_id, error=str(e))
+            return scan, e
+        except Exception as e:
+            print(f"Error launching mri_reface on {scan}: {e}", flush=True)
+            if ledger is not None:
+                ledger.record(scan, LaunchLedger.FAILED, error=str(e))
+            return scan, e
+
+    with ThreadPoolExecutor(max_workers=params.concurrency) as executor:
+        results = list(executor.map(launch, scans))
+
+    print_launch_summary(results)
+    return results
+
+
+# Launch mri_reface on scans through the XNAT bulk launch API, params.bulk_chunk_size scans per request. Returns a list
+# of (scan, error) in scan order, like launch_scans.
+def bulk_launch_scans(xnat_session, params, scans, ledger=None, wrapper_id=None):
+    wrapper_id = wrapper_id or params.command_wrapper_id
+    chunks = [scans[start:start + params.bulk_chunk_size] for start in range(0, len(scans), params.bulk_chunk_size)]
+
+    def launch(chunk):
+        print(f"Bulk launching mri_reface on {len(chunk)} scans starting with {chunk[0]}...", flush=True)
+        try:
+            return chunk, bulk_launch_command_wrapper(xnat_session, params, chunk, wrapper_id), None
+        except Exception as e:
+            print(f"Error bulk launching mri_reface on {len(chunk)} scans starting with {chunk[0]}: {e}", flush=True)
+            return chunk, None, e
+
+    with ThreadPoolExecutor(max_workers=params.concurrency) as executor:
+        outcomes = list(executor.map(launch, chunks))
+
+    results = []
+    bulk_launch_ids = []
+    for chunk, report, error in outcomes:
+        if error is not None:
+            results.extend((scan, error) for scan in chunk)
+            status = LaunchLedger.UNKNOWN if isinstance(error, LaunchOutcomeUnknown) else LaunchLedger.FAILED
+            if ledger is not None:
+                for scan in chunk:
+                    ledger.record(scan, status, wrapper_id=wrapper_id, error=str(error))
+            continue
+        bulk_launch_id = report.get('bulk-launch-id')
+        if bulk_launch_id:
+            bulk_launch_ids.append(bulk_launch_id)
+        failures = {failure.get('params', {}).get('scan'): failure.get('message', 'launch failed')
+                    for failure in report.get('failures', [])}
+        successes = {success.get('params', {}).get('scan'): success for success in report.get('successes', [])}
+        for scan in chunk:
+            error = Exception(failures[scan]) if scan in failures else None
+            results.append((scan, error))
+            if ledger is None:
+                continue
+            if error is None:
+                success = successes.get(scan, {})
+                ledger.record(scan, LaunchLedger.SUBMITTED, wrapper_id=wrapper_id, bulk_launch_id=bulk_launch_id,
+                              container_id=success.get('container-id'), workflow_id=success.get('workflow-id'))
+            else:
+                ledger.record(scan, LaunchLedger.FAILED, bulk_launch_id=bulk_launch_id, error=str(error))
+
+    print_launch_summary(results)
+    if bulk_launch_ids:
+        print(f"Bulk launch IDs: {', '.join(bulk_launch_ids)}", flush=True)
+    return results
+
+
+def print_launch_summary(results):
+    print(f"Launch summary: {len(results)} scans", flush=True)
+    for scan, error in results:
+        if error is None:
+            outcome = 'launched'
+        elif isinstance(error, LaunchOutcomeUnknown):
+            outcome = f'UNKNOWN - {error}'
+        else:
+            outcome = f'FAILED - {error}'
+        print(f"  {scan}: {outcome}", flush=True)
+    failures = len([error for scan, error in results if error is not None])
+    unknown = len([error for scan, error in results if isinstance(error, LaunchOutcomeUnknown)])
+    print(f"Launched {len(results) - failures}, failed {failures - unknown}, unknown {unknown}.", flush=True)
+    if unknown:
+        print(f"Check XNAT for containers of the {unknown} unknown launches before re-running them with "
+              f"--ignore_ledger.", flush=True)
+
+
+# Responses that mean XNAT refused the request without acting on it, so it can be resent without launching twice
+RETRY_STATUS_CODES = [503]
+# Gateway responses given after the request may have been passed on to XNAT, which may have started the container
+UNKNOWN_STATUS_CODES = [502, 504]
+
+
+# POST a launch request to url, retrying with exponential backoff only when the request was not received: on
+# connection failures before it was sent and on 503 responses. A launch is not idempotent, so a timeout, a dropped
+# connection after the request was sent or a 502/504 gateway response raises LaunchOutcomeUnknown instead of resending
+# it.
+def post_with_retry(xnat_session, params, url, **kwargs):
+    for attempt in range(params.retries + 1):
+        try:
+            response = xnat_session.post(url, timeout=params.timeout, **kwargs)
+            if response.status_code in UNKNOWN_STATUS_CODES:
+                raise LaunchOutcomeUnknown(f'POST {url} returned {response.status_code} from a gateway')
+            if response.status_code not in RETRY_STATUS_CODES or attempt == params.retries:
+                return response
+            print(f"POST {url} returned {response.status_code}, retrying.", flush=True)
+        except (requests.Timeout, requests.ConnectionError) as e:
+            if not request_not_sent(e):
+                raise LaunchOutcomeUnknown(f'No response to POST {url}: {e}')
+            if attempt == params.retries:
+                raise
+            print(f"POST {url} failed: {e}, retrying.", flush=True)
+        time.sleep(params.retry_backoff * 2 ** attempt)
+
+
+# Return True if a requests exception was raised while connecting, before any of the request was sent
+def request_not_sent(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def launch_command_wrapper(xnat_session, params, scan, wrapper_id=None):
+    wrapper_id = wrapper_id or params.command_wrapper_id
+    launch_string = f'{params.xnat_host}/xapi/projects/{params.project}/wrappers/{wrapper_id}/root/scan/launch'
+    response = post_with_retry(xnat_session, params, launch_string,
+                               json={'scan': scan,
+                                     'scan-class-file': '/archive/projects/'+params.project+'/resources/DICOM_LM_CLASSIFIER_OUTPUT/files/' + params.xnat_scan_class_filename})
     if response.status_code != 200:
         raise Exception(
-            f'Failed to launch command wrapper {params.command_wrapper_id} on scan {scan} with status code {response.status_code}\n {response.text}')
+            f'Failed to launch command wrapper {wrapper_id} on scan {scan} with status code {response.status_code}\n {response.text}')
     else:
         print(f"Launched mri_reface on {scan}", flush=True)
         print(f"Response: {response.text}", flush=True)
@@ -51,9 +228,30 @@ def launch_command_wrapper(xnat_session, params, scan):
     return response.json()
 
 
+# Submit many scans in one request to the container service bulk launch endpoint. The root element value is a JSON list
+# of scan URIs; the other inputs are shared by every launch.
+def bulk_launch_command_wrapper(xnat_session, params, scans, wrapper_id=None):
+    wrapper_id = wrapper_id or params.command_wrapper_id
+    launch_string = f'{params.xnat_host}/xapi/projects/{params.project}/wrappers/{wrapper_id}/root/scan/bulklaunch'
+    response = post_with_retry(xnat_session, params, launch_string,
+                               json={'scan': json.dumps(scans),
+                                     'scan-class-file': '/archive/projects/'+params.project+'/resources/DICOM_LM_CLASSIFIER_OUTPUT/files/' + params.xnat_scan_class_filename})
+    if response.status_code != 200:
+        raise Exception(
+            f'Failed to bulk launch command wrapper {wrapper_id} on {len(scans)} scans with status code {response.status_code}\n {response.text}')
+    else:
+        print(f"Bulk launched mri_reface on {len(scans)} scans: {response.json().get('bulk-launch-id')}", flush=True)
+
+    return response.json()
+
+
 def start_xnat_session(params):
     session = requests.Session()
     session.auth = (params.xnat_user, params.xnat_pass)
+    # Keep enough pooled keep-alive connections for every concurrent launch
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=params.concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
     # Test the connection
     response = session.get(params.xnat_host)
@@ -75,6 +273,32 @@ def parse_command_line_parameters():
                                             'Columns must include: experiment, scan', required=True)
     parser.add_argument('--xnat_scan_class_filename', help='XNAT Project Resource scan classification CSV filename, if different than csv_input filename.')
     parser.add_argument('--command_wrapper_id', help='XNAT command wrapper ID')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum number of concurrent launch requests')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Number of times a launch is retried after a connection failure or 503 response. Read '
+                             'timeouts and 502/504 responses are recorded as unknown in the ledger rather than retried.')
+    parser.add_argument('--retry_backoff', type=float, default=1.0,
+                        help='Seconds to wait before the first retry, doubled on each further retry')
+    parser.add_argument('--timeout', type=float, default=60, help='Launch request timeout in seconds')
+    parser.add_argument('--bulk', action='store_true', help='Submit scans through the XNAT bulk launch API')
+    parser.add_argument('--bulk_chunk_size', type=int, default=100, help='Number of scans per bulk launch request')
+    parser.add_argument('--ledger', help='JSONL file recording launched scans, used to skip them on re-runs '
+                                         '(default: mri_reface_ledger_<project>.jsonl)')
+    parser.add_argument('--ignore_ledger', action='store_true',
+                        help='Launch scans even if the ledger shows them as already submitted or with an unknown '
+                             'launch outcome')
+    parser.add_argument('--auto_memory', action='store_true',
+                        help='Route each scan to the standard or high memory wrapper from its estimated memory use')
+    parser.add_argument('--memory_calibration', nargs='*', default=[],
+                        help='reface_metrics.json files, directories containing them, or JSONL files of past runs, '
+                             'used to calibrate memory estimates')
+    parser.add_argument('--standard_memory_mb', type=int, default=8000,
+                        help='Memory limit of the standard wrapper; scans estimated above it use the high memory one')
+    parser.add_argument('--highmem_wrapper_id', help='XNAT high memory command wrapper ID')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Report which scans would be launched without launching them')
+    parser.add_argument('--skip_refaced', action='store_true',
+                        help='Skip scans that already have a REFACED_DICOM resource')
 
     args = parser.parse_args()
 
@@ -86,40 +310,130 @@ def parse_command_line_parameters():
     if not args.xnat_pass:
         args.xnat_pass = getpass.getpass('XNAT password: ')
 
+    if not args.ledger:
+        args.ledger = f'mri_reface_ledger_{args.project}.jsonl'
+
     return args
 
 
-def getScans(xnat_session, params):
+def getScans(xnat_session, params, ledger=None, metadata=None):
+    if metadata is None:
+        metadata = XnatMetadata(xnat_session, params.xnat_host, params.project, concurrency=params.concurrency,
+                                timeout=params.timeout)
     # Get experiment IDs
-    exp_ids = get_experiment_ids(xnat_session, params)
-
-    with open(params.csv_input, 'r') as f:
-        reader = csv.DictReader(f)
-        scans = []
-        for row in reader:
-            if row['experiment'] not in exp_ids:
-                print(f"Experiment {row['experiment']} not found in XNAT.", flush=True)
-                continue
-            exp_id = exp_ids[row['experiment']];
-            scans.append((get_scan_uri(xnat_session, params.project, exp_id, row['scan'])))
+    exp_ids = metadata.experiments()
+
+    candidates = []
+    skipped = Counter()
+    for experiment, scan_id in preflight_scans(params):
+        if experiment not in exp_ids:
+            print(f"Experiment {experiment} not found in XNAT.", flush=True)
+            continue
+        exp_id = exp_ids[experiment];
+        scan = get_scan_uri(xnat_session, params.project, exp_id, scan_id)
+        if ledger is not None and not params.ignore_ledger and ledger.is_done(scan):
+            skipped[ledger.status(scan)] += 1
+            continue
+        candidates.append((exp_id, scan_id, scan))
+    if skipped:
+        print(f"Skipping {sum(skipped.values())} scans already launched according to {ledger.file_path}.", flush=True)
+    if skipped[LaunchLedger.UNKNOWN]:
+        print(f"{skipped[LaunchLedger.UNKNOWN]} of them have an unknown launch outcome; check XNAT for their "
+              f"containers and re-run with --ignore_ledger to relaunch any that did not start.", flush=True)
+
+    # Scan existence comes from the project listing; resources are only fetched, per experiment, for --skip_refaced.
+    # If the server leaves the scan column out of the listing, every experiment's scans are fetched instead.
+    project_scans = metadata.project_scans()
+    experiment_scans = None
+    if project_scans is None:
+        print("XNAT listed no scan IDs for the project, checking the scans of each experiment.", flush=True)
+        experiment_scans = metadata.prefetch(exp_id for exp_id, scan_id, scan in candidates)
+        project_scans = experiment_scans
+    existing = []
+    for exp_id, scan_id, scan in candidates:
+        scan_ids = project_scans.get(exp_id, ())
+        if isinstance(scan_ids, Exception):
+            print(f"Could not check scans of experiment {exp_id}, launching {scan} unchecked: {scan_ids}", flush=True)
+            existing.append((exp_id, scan_id, scan))
+        elif scan_id in scan_ids:
+            existing.append((exp_id, scan_id, scan))
+        else:
+            print(f"Scan {scan_id} not found in experiment {exp_id}.", flush=True)
+    experiment_resources = {}
+    if params.skip_refaced:
+        experiment_resources = experiment_scans or metadata.prefetch(exp_id for exp_id, scan_id, scan in existing)
+    scans = []
+    refaced = 0
+    for exp_id, scan_id, scan in existing:
+        scan_resources = experiment_resources.get(exp_id)
+        if isinstance(scan_resources, Exception):
+            print(f"Could not check resources of experiment {exp_id}, launching {scan} unchecked: {scan_resources}",
+                  flush=True)
+        elif scan_resources is not None and 'REFACED_DICOM' in scan_resources.get(scan_id, []):
+            refaced += 1
+            if ledger is not None:
+                ledger.record(scan, LaunchLedger.FINISHED)
+            continue
+        scans.append(scan)
+    if params.skip_refaced:
+        print(f"Skipping {refaced} scans that already have a REFACED_DICOM resource.", flush=True)
     return scans
 
 
+# Collapse the per-file rows of the CSV to unique (experiment, scan) pairs and, if the CSV carries scan classification
+# columns, drop the scans xnat_reface.py would reject. Prints a pre-flight report of what will run.
+def preflight_scans(params):
+    classifier = ScanClassifierCSV(params.csv_input)
+    scan_keys = classifier.scans()
+    rows = sum(classifier.get_scan(*scan_key).file_count for scan_key in scan_keys)
+    print(f"Found {len(scan_keys)} unique scans in {rows} rows of {params.csv_input}.", flush=True)
+    if not classifier.can_classify():
+        print(f"{params.csv_input} has no scan classification columns, all scans will be launched.", flush=True)
+        return scan_keys
+
+    errors = {}
+    im_types = classifier.get_im_types(scan_keys, errors)
+    for (experiment, scan_id), error in errors.items():
+        print(f"Skipping scan {scan_id} in experiment {experiment}: {error}", flush=True)
+    counts = ', '.join(f'{im_type}: {count}' for im_type, count in sorted(Counter(im_types.values()).items()))
+    print(f"{len(im_types)} scans will be refaced ({counts}), {len(errors)} rejected.", flush=True)
+    return [scan_key for scan_key in scan_keys if scan_key in im_types]
+
+
+# Group scans by the wrapper that should launch them: the standard wrapper if the estimated peak memory fits in
+# params.standard_memory_mb, the high memory wrapper otherwise. Returns {wrapper_id: [scan, ...]}.
+def assign_wrappers(xnat_session, params, scans, metadata):
+    if params.memory_calibration:
+        estimator = MemoryEstimator.calibrate(read_calibration_records(params.memory_calibration))
+    else:
+        estimator = MemoryEstimator()
+    if not params.highmem_wrapper_id:
+        params.highmem_wrapper_id = get_wrapper_id(xnat_session, params.xnat_host, "mri_reface_highmem",
+                                                   "mri-reface-scan-highmem")
+
+    classifier = ScanClassifierCSV(params.csv_input)
+    labels = {exp_id: label for label, exp_id in metadata.experiments().items()}
+    # Slice counts come from the frame counts in the project listing already fetched for the existence checks
+    frames = metadata.scan_frames()
+    wrapper_scans = {params.command_wrapper_id: [], params.highmem_wrapper_id: []}
+    for scan in scans:
+        exp_id, scan_id = parse_scan_uri(scan)
+        estimate = estimator.estimate_scan_mb(classifier.get_scan(labels.get(exp_id), scan_id),
+                                              frames.get((exp_id, scan_id)))
+        if estimate > params.standard_memory_mb:
+            print(f"Estimated {estimate:.0f} MB for {scan}, using high memory wrapper.", flush=True)
+            wrapper_scans[params.highmem_wrapper_id].append(scan)
+        else:
+            wrapper_scans[params.command_wrapper_id].append(scan)
+    print(f"{len(wrapper_scans[params.command_wrapper_id])} scans use the standard wrapper, "
+          f"{len(wrapper_scans[params.highmem_wrapper_id])} the high memory wrapper.", flush=True)
+    return {wrapper_id: scans for wrapper_id, scans in wrapper_scans.items() if scans}
+
+
 def get_scan_uri(xnat_session, params, experiment, scan):
     return f'/archive/experiments/{experiment}/scans/{scan}'
 
 
-def get_experiment_ids(xnat_session, params):
-    label_id_map = {}
-    url = f"{params.xnat_host}/data/archive/projects/{params.project}/experiments"
-    response = xnat_session.get(url, json={'columns': "ID,label"})
-    if response.status_code != 200:
-        raise Exception(f'Failed to get experiments from XNAT at {params.xnat_host} with status code {response.status_code}')
-    experiments = response.json()["ResultSet"]["Result"]
-    for experiment in experiments:
-        label_id_map[experiment['label']] = experiment['ID']
-    return label_id_map
-
 def get_wrapper_id(session, xnat_host, command_name, wrapper_name):
     # Send a GET request to the /xapi/commands endpoint
     response = session.get(f'{xnat_host}/xapi/commands')
@@ -4,89 +4,340 @@
 # Launch the mri_reface shell script
 import argparse
 import csv
+import errno
+import functools
+import gzip
+import hashlib
 import logging
+import multiprocessing
 import subprocess
 import sys
 import time
 import glob
 import shutil
-import xnat
+import tempfile
 import os
+import resource
+import requests
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pydicom import dcmread, dcmwrite
-from pydicom.misc import is_dicom
+from pydicom.errors import InvalidDicomError
+from pydicom.uid import DeflatedExplicitVRLittleEndian
 
+from RegistrationCache import RegistrationCache
 from ScanClassifierCSV import ScanClassifierCSV
+from StageMetrics import StageMetrics, add_worker_usage, directory_usage, usage_cpu_seconds, usage_peak_rss_mb
+from TagEditScript import TagEditScript
+from XnatMetadata import XnatMetadata
 
 
 # See https://www.nitrc.org/projects/mri_reface for more information
 
+# DICOM modalities of the series each mri_reface imType can be run on, for every imType mri_reface supports
+IM_TYPE_MODALITIES = {'T1': ['MR'], 'T2': ['MR'], 'FLAIR': ['MR'], 'FDG': ['PT'], 'PIB': ['PT'], 'FBP': ['PT'],
+                      'TAU': ['PT'], 'CT': ['CT']}
+
+
+# Raised when run_mri_reface.sh exits non-zero, so the container exits with the same code
+class MriRefaceError(Exception):
+    def __init__(self, returncode):
+        super().__init__(f'mri_reface failed with exit code {returncode}')
+        self.returncode = returncode
+
 
 def main():
+    metrics = None
+    param = None
+    metadata = None
     try:
         param = parse_command_line_parameters()
-        input_dir = param.input
+        # One XNAT session serves every --delete_existing request of the run
+        if param.delete_existing:
+            metadata = xnat_metadata(param)
+
+        # Session mode: reface several scans of the experiment in this container
+        if param.scans is not None or param.all_scans:
+            failures = reface_session(param, metadata)
+            if failures:
+                sys.exit(f'Error launching mri_reface: {len(failures)} scans failed: {", ".join(failures)}')
+            return
+
+        metrics = StageMetrics(project=param.project, experiment=param.experiment, scan=param.scan,
+                               workers=param.workers)
 
         # If scan_type is not specified, parse csv file to extract scan type
-        if param.scan_type is not None:
-            scan_type = param.scan_type
-        else:
-            scan_type = extract_im_type(param.csv, param.experiment, param.scan)
+        with metrics.stage('classify'):
+            if param.scan_type is not None:
+                scan_type = param.scan_type
+            else:
+                scan_type = extract_im_type(param.csv, param.experiment, param.scan)
+        metrics.run_info['scan_type'] = scan_type
 
-        # if delete_existing is True, delete existing output resources
-        if param.delete_existing:
-            delete_reface_outputs(param)
-
-        print('Collecting Window Center and Window Width tags from reference file.', flush=True)
-
-        # Return the Window Center, Window Width, and Explanation tags from a DICOM file (or first file in a directory)
-        [center, width, explanation] = get_window_tags(param.input)
-
-        # If manufacture tag is not set, set it to 'anonymized'
-        if is_missing_manufacture_tag(input_dir):
-            print('Missing Manufacture tag, setting to "anonymized".', flush=True)
-            staged_input = os.path.join(param.output, 'input0')
-            os.makedirs(staged_input)
-            add_manufacture_tag(input_dir, staged_input, 'anonymized')
-            input_dir = staged_input
-
-        # remove protocol tags (0018,1030) & (0008,103E) before refacing
-        if param.delete_protocol_tags:
-            print('Deleting protocol tags.', flush=True)
-            staged_input = os.path.join(param.output, 'input1')
-            os.mkdir(staged_input)
-            delete_protocol_tags(input_dir, staged_input)
-            input_dir = staged_input
-
-        print('Launching mri_reface...', flush=True)
-        launch_shell_script(param.mri_reface_script,input_dir, param.output, scan_type, param.mri_reface_opts)
-
-        if center is not None and width is not None:
-            apply_window_tags(param.output, center, width, explanation)
-
-        # Stage output files
-        print('Staging output files...', flush=True)
-        refaced_nifti_output_dir = f'{param.output}/refaced_nifti'
-        subprocess.run(['mkdir', refaced_nifti_output_dir])
-        print(f"Moving refaced nifti files to {refaced_nifti_output_dir}", flush=True)
-        stage_output_files(param.output, refaced_nifti_output_dir, '*deFaced.nii')
-        stage_output_files(param.output, refaced_nifti_output_dir, '*Warp.nii')
-
-        nifti_output_dir = f'{param.output}/nifti'
-        subprocess.run(['mkdir', nifti_output_dir])
-        print(f"Moving nifti files to {nifti_output_dir}", flush=True)
-        stage_output_files(param.output, nifti_output_dir, '*.nii')
-
-        if param.input != input_dir and os.path.exists(input_dir):
-            print(f"Removing staged input files from {input_dir}", flush=True)
-            try:
-                shutil.rmtree(input_dir)
-            except Exception as e:
-                print(f"Error removing staged input files from {input_dir}: {e}", flush=True)
+        prepared = prepare_scan(param, param.scan, scan_type, param.input, param.output, metrics, metadata)
+        finish_scan(param, scan_type, param.input, param.output, prepared, metrics)
 
+    except MriRefaceError as e:
+        print(f'Error launching mri_reface: {e}', flush=True)
+        # Exit statuses of processes killed by a signal are reported as 128 + signal number, like the shell does
+        sys.exit(e.returncode if e.returncode > 0 else 128 - e.returncode)
     except csv.Error as e:
         sys.exit(f'Error parsing CSV file: {e}')
     except Exception as e:
         sys.exit(f'Error launching mri_reface: {e}')
+    finally:
+        if metrics is not None and param.metrics:
+            metrics.write(os.path.join(param.output, param.metrics))
+        if metadata is not None:
+            metadata.session.close()
+
+
+# Validate, delete existing outputs if requested and preprocess the input series of a scan. metadata is the
+# XnatMetadata used to delete existing outputs. Returns the directory mri_reface should read from, followed by the
+# Window Center, Window Width, and Explanation tags.
+def prepare_scan(param, scan, scan_type, input_dir, output_dir, metrics, metadata=None):
+    # Reject scans mri_reface cannot run on before any outputs are deleted or files are staged
+    if not param.skip_validation:
+        with metrics.stage('validate') as stage:
+            stage.update(validate_scan(param, scan_type, input_dir, output_dir))
+
+    # if delete_existing is True, delete existing output resources
+    if param.delete_existing:
+        with metrics.stage('delete_existing'):
+            delete_reface_outputs(param, metadata, scan)
+
+    # Read the input series once, collecting the Window Center, Window Width, and Explanation tags and
+    # applying the Manufacturer fill-in and protocol tag deletion in a single staged copy
+    print(f'Preprocessing input DICOM files of scan {scan}.', flush=True)
+    staged_input = os.path.join(output_dir, 'input0')
+    with metrics.stage('preprocess') as stage:
+        # The series geometry is recorded so past runs can calibrate the launcher's memory estimates
+        prepared = preprocess_input(input_dir, staged_input, param.delete_protocol_tags, 'anonymized', param.workers,
+                                    param.tag_edit, metrics.run_info)
+        stage['files'], stage['bytes'] = directory_usage(input_dir)
+        stage['staged'] = prepared[0] != input_dir
+    return prepared
+
+
+# Run mri_reface on a prepared scan, restore its window tags and stage its outputs
+def finish_scan(param, scan_type, original_input, output_dir, prepared, metrics):
+    input_dir, center, width, explanation = prepared
+    reg_cache, reg_key, reg_file = None, None, None
+    if param.reg_cache_dir and '-regFile' not in (param.mri_reface_opts or '').split():
+        reg_cache = RegistrationCache(param.reg_cache_dir, param.reg_file_pattern)
+        with metrics.stage('reg_cache_lookup') as stage:
+            pixel_digests = series_pixel_digests(input_dir, param.workers)
+            reg_key = reg_cache.key(pixel_digests, scan_type, param.mri_reface_opts)
+            reg_file = reg_cache.lookup(reg_key)
+            stage['files'] = len(pixel_digests)
+            stage['key'] = reg_key
+            stage['hit'] = reg_file is not None
+        if reg_file is not None:
+            print(f"Using cached registration {reg_file}", flush=True)
+
+    print('Launching mri_reface...', flush=True)
+    with metrics.stage('mri_reface') as stage:
+        stage['files'], stage['bytes'] = directory_usage(input_dir)
+        result, stage['process_peak_rss_mb'] = launch_shell_script(param.mri_reface_script,input_dir, output_dir,
+                                                                    scan_type, param.mri_reface_opts, reg_file)
+        stage['returncode'] = result.returncode
+        if result.returncode != 0:
+            # Raised inside the stage so it is recorded as failed
+            remove_staged_input(original_input, input_dir)
+            raise MriRefaceError(result.returncode)
+
+    if reg_cache is not None and reg_file is None and result.returncode == 0:
+        try:
+            reg_cache.store(reg_key, output_dir)
+        except OSError as e:
+            print(f"Could not cache registration in {param.reg_cache_dir}: {e}", flush=True)
+
+    if center is not None and width is not None:
+        # The staged input is removed below, so it does not need window tags
+        exclude = input_dir if input_dir != original_input else None
+        with metrics.stage('apply_window_tags') as stage:
+            apply_window_tags(output_dir, center, width, explanation, param.workers, exclude=exclude)
+            stage['files'], stage['bytes'] = directory_usage(output_dir, exclude=exclude)
+
+    # Stage output files
+    print('Staging output files...', flush=True)
+    with metrics.stage('stage_outputs') as stage:
+        staged_files = stage_outputs(output_dir, param.compress_nifti, param.workers, param.nifti_compress_level)
+        stage['files'] = len(staged_files)
+        stage['bytes'] = sum(os.path.getsize(staged_file) for staged_file in staged_files)
+
+        remove_staged_input(original_input, input_dir)
+
+
+def remove_staged_input(original_input, input_dir):
+    if original_input != input_dir and os.path.exists(input_dir):
+        print(f"Removing staged input files from {input_dir}", flush=True)
+        try:
+            shutil.rmtree(input_dir)
+        except Exception as e:
+            print(f"Error removing staged input files from {input_dir}: {e}", flush=True)
+
+
+# Pre-flight checks run before any heavy work, so a scan mri_reface cannot process fails in seconds:
+#   - the output directories and the MATLAB runtime cache directory are writable,
+#   - the input holds DICOM files of a single series, whose modality matches scan_type and whose body part is a head,
+#     judged from the headers of a sample of param.validation_sample files spread across the input,
+#   - the sampled slices agree on matrix size and the series has at least param.min_slices slices,
+#   - the output and cache file systems have room for the staged input and mri_reface outputs.
+# Raises an exception listing every problem found; returns a summary of what was checked otherwise.
+def validate_scan(param, scan_type, input_dir, output_dir):
+    problems = []
+    if scan_type not in IM_TYPE_MODALITIES:
+        problems.append(f'imType {scan_type} is not supported by mri_reface '
+                        f'({"|".join(IM_TYPE_MODALITIES)}).')
+
+    cache_dir = os.getenv('MCR_CACHE_ROOT') or tempfile.gettempdir()
+    output_dirs = [output_dir] + [os.path.join(output_dir, name) for name in ['dcm', 'nifti', 'refaced_nifti']
+                                  if os.path.isdir(os.path.join(output_dir, name))]
+    for directory in output_dirs + [cache_dir]:
+        if not is_writable(directory):
+            problems.append(f'{directory} is not a writable directory.')
+
+    input_files = list_files(input_dir) if os.path.isdir(input_dir) else []
+    if not input_files:
+        problems.append(f'No input files found in {input_dir}.')
+        raise Exception('Pre-flight validation failed: ' + ' '.join(problems))
+
+    headers = sample_headers(input_files, param.validation_sample)
+    if not headers:
+        problems.append(f'No DICOM files found among the {len(input_files)} files in {input_dir}.')
+        raise Exception('Pre-flight validation failed: ' + ' '.join(problems))
+
+    modalities = {header.modality for header in headers if header.modality}
+    expected_modalities = IM_TYPE_MODALITIES.get(scan_type, [])
+    if expected_modalities and modalities - set(expected_modalities):
+        problems.append(f'Modality {"/".join(sorted(modalities))} does not match imType {scan_type}, '
+                        f'which expects {"/".join(expected_modalities)}.')
+    body_parts = {header.body_part for header in headers
+                  if header.body_part.lower() not in ScanClassifierCSV.HEAD_BODY_PARTS}
+    if body_parts:
+        problems.append(f'Body part {"/".join(sorted(body_parts))} not supported.')
+    series = {header.series_uid for header in headers}
+    if len(series) > 1:
+        problems.append(f'Input contains {len(series)} series; mri_reface needs a single series.')
+    matrices = {(header.rows, header.columns) for header in headers}
+    if len(matrices) > 1:
+        sizes = ', '.join(f'{rows}x{columns}' for rows, columns in sorted(matrices))
+        problems.append(f'Slices differ in size: {sizes}.')
+
+    # Scale the sampled frame count up to every file, assuming non-DICOM files are as common as in the sample
+    dicom_fraction = len(headers) / min(len(input_files), param.validation_sample)
+    slices = round(sum(header.frames for header in headers) / len(headers) * len(input_files) * dicom_fraction)
+    if slices < param.min_slices:
+        problems.append(f'Series has about {slices} slices; at least {param.min_slices} are needed.')
+
+    # Staged copy and refaced DICOM are about the size of the input; NIfTI volumes are written as 32-bit floats
+    input_bytes = sum(os.path.getsize(input_file) for input_file in input_files)
+    rows, columns = max(matrices)
+    volume_bytes = rows * columns * slices * 4
+    needed = {output_dir: 2 * input_bytes + 4 * volume_bytes, cache_dir: param.min_tmp_free_mb * 1024 * 1024}
+    if os.path.isdir(output_dir) and os.path.isdir(cache_dir) \
+            and os.stat(output_dir).st_dev == os.stat(cache_dir).st_dev:
+        # One file system holds both
+        needed = {output_dir: sum(needed.values())}
+    for directory, needed_bytes in needed.items():
+        if not os.path.isdir(directory):
+            continue
+        free_bytes = shutil.disk_usage(directory).free
+        if free_bytes < needed_bytes:
+            problems.append(f'{directory} has {free_bytes // (1024 * 1024)} MB free; about '
+                            f'{needed_bytes // (1024 * 1024)} MB are needed.')
+
+    if problems:
+        raise Exception('Pre-flight validation failed: ' + ' '.join(problems))
+    print(f"Pre-flight validation passed: {len(headers)} sampled headers, about {slices} slices of {rows}x{columns}, "
+          f"modality {'/'.join(sorted(modalities)) or 'unknown'}.", flush=True)
+    return {'files': len(input_files), 'bytes': input_bytes, 'sampled': len(headers), 'slices': slices}
+
+
+# Return the DicomHeader of up to sample_size files spread evenly across input_files, skipping non-DICOM files
+def sample_headers(input_files, sample_size):
+    step = max(1, len(input_files) / sample_size)
+    sample = [input_files[int(index * step)] for index in range(min(sample_size, len(input_files)))]
+    return [header for header in map(read_header, sample) if header is not None]
+
+
+def is_writable(directory):
+    try:
+        with tempfile.TemporaryFile(dir=directory):
+            return True
+    except OSError:
+        return False
+
+
+# Reface several scans of param.experiment, given by --scans or, with --all_scans, every scan of the experiment the
+# classifier CSV marks as refaceable. The next scan is preprocessed while mri_reface runs on the current one, and the
+# container start and MCR cache extraction are paid once for all of them. metadata, the XnatMetadata of the run, is
+# shared by every scan's --delete_existing requests. Outputs go to per-scan subdirectories of param.output, which the
+# XNAT command wrappers do not upload, so session mode is for command line runs. Returns the scans that failed.
+def reface_session(param, metadata=None):
+    scan_types = session_scan_types(param)
+    print(f"Refacing {len(scan_types)} scans of experiment {param.experiment}: {', '.join(scan_types)}", flush=True)
+    failures = [scan for scan, scan_type in scan_types.items() if scan_type is None]
+    scans = [scan for scan, scan_type in scan_types.items() if scan_type is not None]
+
+    def prepare(scan):
+        metrics = StageMetrics(project=param.project, experiment=param.experiment, scan=scan,
+                               workers=param.workers, scan_type=scan_types[scan])
+        input_dir = scan_input_dir(param.input, param.experiment, scan)
+        output_dir = os.path.join(param.output, scan)
+        os.makedirs(output_dir, exist_ok=True)
+        return metrics, input_dir, output_dir, prepare_scan(param, scan, scan_types[scan], input_dir, output_dir,
+                                                            metrics, metadata)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_scan = executor.submit(prepare, scans[0]) if scans else None
+        for index, scan in enumerate(scans):
+            current_scan = next_scan
+            next_scan = executor.submit(prepare, scans[index + 1]) if index + 1 < len(scans) else None
+            metrics, output_dir = None, os.path.join(param.output, scan)
+            try:
+                metrics, input_dir, output_dir, prepared = current_scan.result()
+                finish_scan(param, scan_types[scan], input_dir, output_dir, prepared, metrics)
+            except Exception as e:
+                print(f"Error refacing scan {scan}: {e}", flush=True)
+                failures.append(scan)
+            finally:
+                if metrics is not None and param.metrics:
+                    metrics.write(os.path.join(output_dir, param.metrics))
+    return failures
+
+
+# Return {scan: imType} for the scans of a session run, with None for scans that cannot be refaced
+def session_scan_types(param):
+    classifier = ScanClassifierCSV(param.csv) if param.csv is not None else None
+    if param.all_scans:
+        scans = [scan for experiment, scan in classifier.scans() if experiment == param.experiment]
+    else:
+        scans = [scan.strip() for scan in param.scans.split(',') if scan.strip()]
+        if param.scan_type is not None:
+            return {scan: param.scan_type for scan in scans}
+
+    errors = {}
+    im_types = classifier.get_im_types([(param.experiment, scan) for scan in scans], errors)
+    for (experiment, scan), error in errors.items():
+        print(f"Skipping scan {scan}: {error}", flush=True)
+    if param.all_scans:
+        # Only refaceable scans are selected; --scan_type then overrides their classified imType
+        return {scan: param.scan_type or im_types[(param.experiment, scan)] for scan in scans
+                if (param.experiment, scan) in im_types}
+    return {scan: im_types.get((param.experiment, scan)) for scan in scans}
+
+
+# Return the DICOM directory of a scan in a session-level input mount
+def scan_input_dir(input_dir, experiment, scan):
+    for candidate in [os.path.join(input_dir, 'SCANS', scan, 'DICOM'),
+                      os.path.join(input_dir, experiment or '', 'SCANS', scan, 'DICOM'),
+                      os.path.join(input_dir, 'SCANS', scan),
+                      os.path.join(input_dir, scan, 'DICOM'),
+                      os.path.join(input_dir, scan)]:
+        if os.path.isdir(candidate):
+            return candidate
+    raise Exception(f'No input directory found for scan {scan} in {input_dir}')
 
 
 def parse_command_line_parameters():
@@ -100,6 +351,11 @@ def parse_command_line_parameters():
     parser.add_argument('--project', required=False, default=None, help='Specify project id.')
     parser.add_argument('--experiment', required=False, default=None, help='Specify experiment name.')
     parser.add_argument('--scan', required=False, default=None, help='Specify scan name.')
+    parser.add_argument('--scans', required=False, default=None,
+                        help='Comma-separated scans of the experiment to reface in this container. The input directory '
+                             'is a session mount (SCANS/<scan>/DICOM); outputs go to <output>/<scan>.')
+    parser.add_argument('--all_scans', required=False, action='store_true',
+                        help='Reface every scan of the experiment that the CSV classifies as refaceable, as --scans.')
     parser.add_argument('--mri_reface_opts', required=False, help='Specify optional mri_reface arguments.')
     parser.add_argument('--input', required=False, default='/input', help='DICOM Scan input directory')
     parser.add_argument('--output', required=False, default='/output', help='mri_reface output directory')
@@ -107,6 +363,35 @@ def parse_command_line_parameters():
                                                                                 'REFACED_QC, REFACED_DICOM, NIFTI, '
                                                                                 'REFACED_NIFTI')
     parser.add_argument('--delete_protocol_tags', required=False, action='store_true', help='Delete protocol tags (0018,1030) & (0008,103E) before refacing')
+    parser.add_argument('--tag_edit_script', required=False, default=None,
+                        help='DicomEdit-style script of tag deletions -(gggg,eeee) and assignments '
+                             '(gggg,eeee) := "value" applied to the input before refacing, e.g. '
+                             'remove-protocol-name.txt')
+    parser.add_argument('--skip_validation', required=False, action='store_true',
+                        help='Skip the pre-flight checks of the input, imType, mounts and free space.')
+    parser.add_argument('--validation_sample', required=False, type=int, default=16,
+                        help='Number of input files whose headers are read by the pre-flight checks.')
+    parser.add_argument('--min_slices', required=False, type=int, default=10,
+                        help='Minimum number of slices in the input series.')
+    parser.add_argument('--min_tmp_free_mb', required=False, type=int, default=1024,
+                        help='Free space needed in the MATLAB runtime cache directory (MCR_CACHE_ROOT or /tmp).')
+    parser.add_argument('--workers', required=False, type=int, default=cpu_allotment(),
+                        help='Number of worker processes used to rewrite DICOM headers (default: CPUs available to the '
+                             'container)')
+    parser.add_argument('--compress_nifti', required=False, action='store_true',
+                        help='Write staged NIfTI outputs gzip-compressed (.nii.gz)')
+    parser.add_argument('--nifti_compress_level', required=False, type=int, default=6, choices=range(1, 10),
+                        metavar='[1-9]', help='gzip level of --compress_nifti outputs (default: 6)')
+    parser.add_argument('--metrics', required=False, default='reface_metrics.json',
+                        help='Name of the per-stage timing and memory JSON written to the output directory '
+                             '(empty to disable)')
+    parser.add_argument('--reg_cache_dir', required=False, default=os.getenv('MRI_REFACE_REG_CACHE'),
+                        help='Directory of cached mri_reface registrations, keyed by input pixel data and imType. A '
+                             'cached registration is passed as -regFile instead of re-running reg_aladin. Defaults to '
+                             'the MRI_REFACE_REG_CACHE environment variable; unset disables the cache.')
+    parser.add_argument('--reg_file_pattern', required=False,
+                        default=os.getenv('MRI_REFACE_REG_PATTERN', '*.txt'),
+                        help='Glob matching the registration file mri_reface writes to the output directory.')
     parser.add_argument("--host", default=os.getenv("XNAT_HOST"),
                         help="XNAT server URL (default: environment variable XNAT_HOST)."
                         )
@@ -119,121 +404,447 @@ def parse_command_line_parameters():
     args = parser.parse_args()
     if args.scan_type is None and args.csv is None:
         raise Exception('Either --scan_type or --csv must be specified.')
+    if args.all_scans and args.csv is None:
+        raise Exception('--all_scans requires --csv.')
+    if (args.scans is not None or args.all_scans) and args.experiment is None:
+        raise Exception('--scans and --all_scans require --experiment.')
+    if args.validation_sample < 1:
+        raise Exception('--validation_sample must be at least 1.')
+    if args.min_slices < 1:
+        raise Exception('--min_slices must be at least 1.')
+    # Compiled once and shared by every file of the preprocessing pass
+    args.tag_edit = TagEditScript.from_file(args.tag_edit_script) if args.tag_edit_script else None
     return args
 
 
+# Return an XnatMetadata of param.project on a new authenticated session, to be closed with metadata.session.close()
+def xnat_metadata(param):
+    session = requests.Session()
+    session.auth = (param.user, param.password)
+    return XnatMetadata(session, param.host, param.project)
+
+
 # Delete existing mri_reface output resources
-def delete_reface_outputs(param):
+def delete_reface_outputs(param, metadata, scan=None):
+    scan = scan or param.scan
     reface_resources = ['REFACED_QC', 'REFACED_DICOM', 'NIFTI', 'REFACED_NIFTI']
-    with xnat.connect(param.host, user=param.user, password=param.password, detect_redirect=False) as session:
-        scan = session.projects[param.project].experiments[param.experiment].scans[param.scan]
-        for resource in reface_resources:
-            try:
-                if resource in scan.resources:
-                    logging.debug(f'Deleting existing reface resource: {resource} on scan {param.scan} in '
-                                  f'experiment {param.experiment}')
-                    scan.resources[resource].delete()
-            except Exception as e:
-                logging.error(f'Error deleting existing reface resource: {resource}: {e} on scan {param.scan} in '
+    existing_resources = metadata.resources(param.experiment, scan)
+    for resource in reface_resources:
+        try:
+            if resource in existing_resources:
+                logging.debug(f'Deleting existing reface resource: {resource} on scan {scan} in '
                               f'experiment {param.experiment}')
+                metadata.delete_resource(param.experiment, scan, resource)
+        except Exception as e:
+            logging.error(f'Error deleting existing reface resource: {resource}: {e} on scan {scan} in '
+                          f'experiment {param.experiment}')
 
 
 # Parse csv output from scan classifier, return mri_reface compatible imType
 def extract_im_type(csv_file, experiment, scan):
-    return ScanClassifierCSV(csv_file).get_im_type(experiment, scan)
+    return ScanClassifierCSV(csv_file, experiment, scan).get_im_type(experiment, scan)
 
 
-def launch_shell_script(script_path, input, output, scan_type, mri_reface_opts):
+# Run run_mri_reface.sh. Returns its CompletedProcess and the peak RSS in MB of the run.
+def launch_shell_script(script_path, input, output, scan_type, mri_reface_opts, reg_file=None):
     # Prepare the command
     command = [script_path, input, output, '-imType', scan_type]
+    if reg_file is not None:
+        command.extend(['-regFile', reg_file])
     print(f"Launching mri_reface with command: {' '.join(command)}", flush=True)
     # Add mri_reface_opts if it is not None
     if mri_reface_opts is not None:
         command.extend(mri_reface_opts.split())
-    # Run the command
-    result = subprocess.run(command)
-    print(f"mri_reface returned with exit code: {result.returncode}", flush=True)
-    return result
+    # Run the command, waiting with wait4 for the resource usage of this run alone (the shell script and the processes
+    # it waited for), rather than the high-water mark of every child of this process
+    process = subprocess.Popen(command)
+    pid, status, usage = os.wait4(process.pid, 0)
+    # Killed by a signal gives a negative return code, as with subprocess.run
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    print(f"mri_reface returned with exit code: {process.returncode}", flush=True)
+    return subprocess.CompletedProcess(command, process.returncode), usage_peak_rss_mb(usage)
 
 
 def stage_output_files(input_dir, output_dir, pattern):
     # Move files from input_dir to output_dir
     for file in glob.glob(f'{input_dir}/{pattern}'):
-        shutil.move(file, output_dir)
+        move_file(file, output_dir)
+
+
+# Move mri_reface NIfTI outputs out of output_dir with a single directory scan: refaced (*deFaced.nii) and warp
+# (*Warp.nii) volumes to refaced_nifti, all other *.nii to nifti. If compress is True, each volume is written as
+# .nii.gz instead, at gzip level compress_level. Returns the staged file paths.
+def stage_outputs(output_dir, compress=False, workers=1, compress_level=6):
+    refaced_nifti_output_dir = os.path.join(output_dir, 'refaced_nifti')
+    nifti_output_dir = os.path.join(output_dir, 'nifti')
+    os.makedirs(refaced_nifti_output_dir, exist_ok=True)
+    os.makedirs(nifti_output_dir, exist_ok=True)
+
+    moves = []
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.name.endswith('.nii') or not entry.is_file():
+                continue
+            if entry.name.endswith('deFaced.nii') or entry.name.endswith('Warp.nii'):
+                moves.append((entry.path, refaced_nifti_output_dir))
+            else:
+                moves.append((entry.path, nifti_output_dir))
+    moves.sort()
+
+    print(f"Moving {len(moves)} nifti files to {refaced_nifti_output_dir} and {nifti_output_dir}", flush=True)
+    if not compress:
+        return [move_file(file, destination_dir) for file, destination_dir in moves]
+    staged_files = []
+    for file, destination_dir in moves:
+        staged_file = os.path.join(destination_dir, os.path.basename(file) + '.gz')
+        gzip_file(file, staged_file, workers, compress_level)
+        os.remove(file)
+        staged_files.append(staged_file)
+    return staged_files
+
+
+# Move file into destination_dir with a rename, copying only when the directory is on another filesystem (the
+# container service mounts each output directory separately). Returns the new path.
+def move_file(file, destination_dir):
+    destination = os.path.join(destination_dir, os.path.basename(file))
+    try:
+        os.replace(file, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(file, destination)
+    return destination
+
+
+# Gzip source into destination, compressing chunk_size blocks on a pool of threads (zlib releases the GIL) and writing
+# each block as its own gzip member, in order. At most workers blocks are held in memory at a time. The default level
+# is 6, as for the gzip command; gzip.compress defaults to 9, which is several times slower for little gain on NIfTI.
+def gzip_file(source, destination, workers=1, level=6, chunk_size=16 * 1024 * 1024):
+    workers = max(workers, 1)
+    compress = functools.partial(gzip.compress, compresslevel=level)
+    with open(source, 'rb') as input_file, open(destination, 'wb') as output_file, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            chunks = [chunk for chunk in (input_file.read(chunk_size) for _ in range(workers)) if chunk]
+            if not chunks:
+                break
+            for member in executor.map(compress, chunks):
+                output_file.write(member)
+    shutil.copymode(source, destination)
+
+
+# Preprocess the DICOM files in input_dir with a header-only pass over every file and at most one full read and write
+# per DICOM file. Window tags are collected from the first file that has them. If any file is missing the Manufacturer
+# tag, every file is staged with Manufacturer set to manufacturer. If delete_protocol is True, protocol tags
+# (0018,1030) & (0008,103E) are blanked in the same write, and a compiled TagEditScript given as tag_edit is applied
+# there too. Window tags are read before any edit. If geometry is a dict, the series geometry from the same header
+# pass is added to it.
+# Returns the directory mri_reface should read from, followed by the Window Center, Window Width, and Explanation tags.
+def preprocess_input(input_dir, staged_input, delete_protocol, manufacturer, workers=1, tag_edit=None, geometry=None):
+    # The headers decide whether any file has to be rewritten
+    headers = dicom_headers(input_dir, workers)
+    if geometry is not None:
+        geometry.update(header_geometry(headers))
+    center, width, explanation = next((header.window_tags for header in headers if header.window_tags[0] is not None),
+                                      (None, None, None))
+    missing_manufacturer = any(not header.has_manufacturer for header in headers)
+    if not (delete_protocol or tag_edit is not None or missing_manufacturer):
+        return input_dir, center, width, explanation
+
+    if missing_manufacturer:
+        print(f'Missing Manufacture tag, setting to "{manufacturer}".', flush=True)
+    os.makedirs(staged_input, exist_ok=True)
+    run_pool(preprocess_file, [(header.path, staged_file(staged_input, header.path), delete_protocol,
+                                manufacturer if missing_manufacturer else None, tag_edit) for header in headers],
+             workers)
+    return staged_input, center, width, explanation
+
+
+# Write a staged copy of a single DICOM file with its protocol tags blanked if delete_protocol is True, the tag_edit
+# script applied, and Manufacturer set to manufacturer unless it is None
+def preprocess_file(input_file, output_file, delete_protocol, manufacturer, tag_edit=None):
+    dicom = dcmread(input_file)
+    if delete_protocol:
+        blank_protocol_tags(dicom)
+    if tag_edit is not None:
+        tag_edit.apply(dicom)
+    if manufacturer is not None:
+        set_manufacture_tag(dicom, manufacturer)
+    dicom.save_as(str(output_file))
+
+
+# Header elements kept in a DicomHeader
+HEADER_TAGS = ['Manufacturer', 'Modality', 'BodyPartExamined', 'SeriesInstanceUID', 'Rows', 'Columns',
+               'BitsAllocated', 'NumberOfFrames', 'WindowCenter', 'WindowWidth', 'WindowCenterWidthExplanation']
+
+
+# Small summary of the header elements inspected by this launcher
+class DicomHeader:
+    __slots__ = ['path', 'manufacturer', 'modality', 'body_part', 'series_uid', 'rows', 'columns',
+                 'bits_allocated', 'frames', 'window_tags']
+
+    def __init__(self, path, dicom):
+        self.path = path
+        self.manufacturer = dicom.get('Manufacturer', '') or ''
+        self.modality = dicom.get('Modality', '') or ''
+        self.body_part = dicom.get('BodyPartExamined', '') or ''
+        self.series_uid = dicom.get('SeriesInstanceUID', '') or ''
+        self.rows = dicom.get('Rows', 0) or 0
+        self.columns = dicom.get('Columns', 0) or 0
+        self.bits_allocated = dicom.get('BitsAllocated', 0) or 0
+        self.frames = int(dicom.get('NumberOfFrames', 1) or 1)
+        self.window_tags = read_window_tags(dicom)
+
+    @property
+    def has_manufacturer(self):
+        return self.manufacturer != ''
+
+
+# Parse only the header of dicom_file, stopping before the pixel data, with a single open of the file.
+# Returns a DicomHeader, or None if the file is not DICOM.
+def read_header(dicom_file):
+    try:
+        dicom = dcmread(dicom_file, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    except InvalidDicomError:
+        return None
+    return DicomHeader(dicom_file, dicom)
+
+
+# Return a DicomHeader for every DICOM file under input_dir, in a stable order
+def dicom_headers(input_dir, workers=1):
+    results = run_pool(read_header, [(input_file,) for input_file in list_files(input_dir)], workers)
+    return [header for header in results if header is not None]
+
 
+# Return the rows, columns, bits allocated and total slice (frame) count of a series from its DicomHeaders
+def header_geometry(headers):
+    if not headers:
+        return {'rows': 0, 'columns': 0, 'slices': 0, 'bits_allocated': 0}
+    return {'rows': headers[0].rows, 'columns': headers[0].columns,
+            'slices': sum(header.frames for header in headers), 'bits_allocated': headers[0].bits_allocated}
 
-def delete_protocol_tags(input_dir, staged_input):
+
+# Return the sha256 of the pixel data of dicom_file, or None if the file is not DICOM
+def pixel_digest(dicom_file):
+    try:
+        dicom = dcmread(dicom_file)
+    except InvalidDicomError:
+        return None
+    return hashlib.sha256(dicom.get('PixelData', b'')).hexdigest()
+
+
+# Return the pixel data digest of every DICOM file under input_dir
+def series_pixel_digests(input_dir, workers=1):
+    results = run_pool(pixel_digest, [(input_file,) for input_file in list_files(input_dir)], workers)
+    return [digest for digest in results if digest is not None]
+
+
+# Return the path of every file under input_dir, in a stable order
+def list_files(input_dir):
+    input_files = []
     for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            input_file = os.path.join(root, file)
-            output_file = os.path.join(staged_input, file)
-            if not is_dicom(str(input_file)): continue
-            dicom = dcmread(input_file)
-            if 'SeriesDescription' in dicom:
-                print( 'Deleting Series Description')
-                dicom.SeriesDescription = ''
-            if 'ProtocolName' in dicom:
-                print( 'Deleting Protocol Name')
-                dicom.ProtocolName = ''
-            dicom.save_as(str(output_file))
+        dirs.sort()
+        for file in sorted(files):
+            input_files.append(os.path.join(root, file))
+    return input_files
+
+
+# Staged copies are written flat into staged_input
+def staged_file(staged_input, input_file):
+    return os.path.join(staged_input, os.path.basename(input_file))
+
+
+# Return the number of CPUs available to this container, honoring cgroup CPU quotas
+def cpu_allotment():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    try:
+        # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = f.read().strip()
+        except OSError:
+            return cpus
+    if quota in ['max', '-1']:
+        return cpus
+    return max(1, min(cpus, int(int(quota) / int(period))))
+
+
+# Run func(*task) for every task on a pool of worker processes. Results are returned in task order. A task that raises
+# does not stop the remaining tasks, but once all have run every failure is reported and an exception is raised, so a
+# partially processed series is never passed on. Workers are started by a fork server rather than forked from this
+# process, which in session mode has a thread preparing the next scan, so their resource usage is not counted as that of
+# children of this process; it is added to the open metrics stage instead.
+def run_pool(func, tasks, workers=1):
+    if workers > 1 and len(tasks) > 1:
+        chunksize = max(1, len(tasks) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
+            measured = list(executor.map(run_measured_task, [func] * len(tasks), tasks, chunksize=chunksize))
+        add_worker_usage(sum(task_cpu for outcome, task_cpu, worker_peak in measured),
+                         max(worker_peak for outcome, task_cpu, worker_peak in measured))
+        outcomes = [outcome for outcome, task_cpu, worker_peak in measured]
+    else:
+        outcomes = [run_task(func, task) for task in tasks]
+
+    results = []
+    failures = 0
+    for task, (result, error) in zip(tasks, outcomes):
+        if error is not None:
+            failures += 1
+            print(f"Error processing {task[0]}: {error}", flush=True)
+        results.append(result)
+    if failures:
+        raise Exception(f"{failures} of {len(tasks)} files failed in {func.__name__}.")
+    return results
+
+
+def run_task(func, task):
+    try:
+        return func(*task), None
+    except Exception as e:
+        return None, e
+
+
+# run_task in a pool worker, also returning the CPU seconds the task took and the worker's peak RSS in MB
+def run_measured_task(func, task):
+    start = usage_cpu_seconds(resource.getrusage(resource.RUSAGE_SELF))
+    outcome = run_task(func, task)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return outcome, usage_cpu_seconds(usage) - start, usage_peak_rss_mb(usage)
+
+
+def blank_protocol_tags(dicom):
+    if 'SeriesDescription' in dicom:
+        dicom.SeriesDescription = ''
+    if 'ProtocolName' in dicom:
+        dicom.ProtocolName = ''
+
+
+def set_manufacture_tag(dicom, tag_value):
+    if 'Manufacturer' not in dicom:
+        dicom.add_new('Manufacturer', 'LO', tag_value)
+    else:
+        dicom.Manufacturer = tag_value
+
+
+# The single file edits below parse each file once and skip files that are not DICOM
+def delete_protocol_file(input_file, output_file):
+    try:
+        dicom = dcmread(input_file)
+    except InvalidDicomError:
+        return False
+    blank_protocol_tags(dicom)
+    dicom.save_as(str(output_file))
+    return True
+
+
+def set_manufacture_file(input_file, output_file, tag_value):
+    try:
+        dicom = dcmread(input_file)
+    except InvalidDicomError:
+        return False
+    set_manufacture_tag(dicom, tag_value)
+    dcmwrite(output_file, dicom)
+    return True
+
+
+def delete_protocol_tags(input_dir, staged_input, workers=1):
+    run_pool(delete_protocol_file, [(input_file, staged_file(staged_input, input_file))
+                                    for input_file in list_files(input_dir)], workers)
 
 def is_missing_manufacture_tag(input_dir):
-    for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            input_file = os.path.join(root, file)
-            if not is_dicom(str(input_file)): continue
-            dicom = dcmread(input_file)
-            if 'Manufacturer' not in dicom or dicom.Manufacturer == '':
-                return True
+    for input_file in list_files(input_dir):
+        header = read_header(input_file)
+        if header is not None and not header.has_manufacturer:
+            return True
     return False
 
-def add_manufacture_tag(input_dir, staged_input, tag_value):
-    for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            input_file = os.path.join(root, file)
-            output_file = os.path.join(staged_input, file)
-            if not is_dicom(str(input_file)): continue
-            dicom = dcmread(input_file)
-            if 'Manufacturer' not in dicom:
-                dicom.add_new('Manufacturer', 'LO', tag_value)
-            else:
-                dicom.Manufacturer = tag_value
-            dcmwrite(output_file, dicom)
+def add_manufacture_tag(input_dir, staged_input, tag_value, workers=1):
+    run_pool(set_manufacture_file, [(input_file, staged_file(staged_input, input_file), tag_value)
+                                    for input_file in list_files(input_dir)], workers)
 
 
 # Return the Window Center, Window Width, and Explanation tags from a DICOM file (or first file in a directory)
 def get_window_tags(dicom_file_or_dir):
     if os.path.isdir(dicom_file_or_dir):
-        for root, dirs, files in os.walk(dicom_file_or_dir):
-            for file in files:
-                dicom_file = os.path.join(root, file)
-                if not is_dicom(str(dicom_file)):
-                    continue
-                center, width, explanation = get_window_tags(dicom_file)
-                if center is not None:
-                    return center, width, explanation
+        for dicom_file in list_files(dicom_file_or_dir):
+            center, width, explanation = get_window_tags(dicom_file)
+            if center is not None:
+                return center, width, explanation
     else:
-        dicom = dcmread(dicom_file_or_dir)
-        center = dicom.WindowCenter if 'WindowCenter' in dicom  else None
-        width = dicom.WindowWidth if 'WindowWidth' in dicom  else None
-        explanation = dicom.WindowCenterWidthExplanation if 'WindowCenterWidthExplanation' in dicom  else None
-        if center and width:
-            return center, width, explanation if explanation else None
+        header = read_header(dicom_file_or_dir)
+        if header is not None and header.window_tags[0] is not None:
+            return header.window_tags
     return None, None, None
 
-def apply_window_tags(dicom_dir, center, width, explanation):
-    # Apply Window Center, Window Width, and Explanation tags to DICOM files in output_dir
-    for root, dirs, files in os.walk(dicom_dir):
-        for file in files:
-            dicom_file = os.path.join(root, file)
-            if not is_dicom(str(dicom_file)):
-                continue
-            dicom = dcmread(dicom_file)
-            dicom.WindowCenter = center
-            dicom.WindowWidth = width
-            if explanation:
-                dicom.WindowCenterWidthExplanation = explanation
-            dicom.save_as(str(dicom_file))
+# Return the Window Center, Window Width, and Explanation tags from a parsed DICOM dataset, or None if either
+# Window Center or Window Width is not set
+def read_window_tags(dicom):
+    center = dicom.WindowCenter if 'WindowCenter' in dicom  else None
+    width = dicom.WindowWidth if 'WindowWidth' in dicom  else None
+    explanation = dicom.WindowCenterWidthExplanation if 'WindowCenterWidthExplanation' in dicom  else None
+    if center and width:
+        return center, width, explanation if explanation else None
+    return None, None, None
+
+# Output files that are never DICOM, skipped without being opened
+NON_DICOM_EXTENSIONS = ('.nii', '.nii.gz', '.gz', '.png', '.jpg', '.txt', '.mat', '.json', '.csv', '.log')
+
+
+def apply_window_tags(dicom_dir, center, width, explanation, workers=1, exclude=None):
+    # Apply Window Center, Window Width, and Explanation tags to DICOM files in output_dir, skipping the exclude
+    # directory and files that are known not to be DICOM
+    dicom_files = [dicom_file for dicom_file in list_files(dicom_dir)
+                   if not dicom_file.lower().endswith(NON_DICOM_EXTENSIONS)
+                   and (exclude is None or os.path.commonpath([exclude, dicom_file]) != exclude)]
+    run_pool(patch_window_file, [(dicom_file, center, width, explanation) for dicom_file in dicom_files], workers)
+    return True
+
+def apply_window_file(dicom_file, center, width, explanation):
+    dicom = dcmread(dicom_file)
+    set_window_tags(dicom, center, width, explanation)
+    dicom.save_as(str(dicom_file))
+
+def set_window_tags(dicom, center, width, explanation):
+    dicom.WindowCenter = center
+    dicom.WindowWidth = width
+    if explanation:
+        dicom.WindowCenterWidthExplanation = explanation
+
+# Set the window tags by rewriting only the header of dicom_file. The header is parsed up to PixelData, rewritten to a
+# temporary file, and the remaining bytes are streamed unchanged from the source before the temporary file replaces
+# it. Returns False if dicom_file is not DICOM.
+def patch_window_file(dicom_file, center, width, explanation):
+    with open(dicom_file, 'rb') as source:
+        try:
+            dicom = dcmread(source, stop_before_pixels=True)
+        except InvalidDicomError:
+            return False
+        if dicom.file_meta.get('TransferSyntaxUID') == DeflatedExplicitVRLittleEndian:
+            # The stream position of a deflated data set does not map to the file, so rewrite it in full
+            source.close()
+            apply_window_file(dicom_file, center, width, explanation)
+            return True
+        pixel_data_offset = source.tell()
+        set_window_tags(dicom, center, width, explanation)
+
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(dicom_file), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as destination:
+                dcmwrite(destination, dicom)
+                source.seek(pixel_data_offset)
+                shutil.copyfileobj(source, destination, 1024 * 1024)
+            shutil.copymode(dicom_file, temp_file)
+            os.replace(temp_file, dicom_file)
+        except Exception:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
     return True
 
 if __name__ == '__main__':